@@ -1,11 +1,8 @@
 """
 Application Configuration
 """
-try:
-    from pydantic_settings import BaseSettings
-except ImportError:
-    from pydantic import BaseSettings
-from typing import Optional
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Dict, Optional
 
 
 class Settings(BaseSettings):
@@ -21,12 +18,18 @@ class Settings(BaseSettings):
     
     # Database
     DATABASE_URL: str = "sqlite:///./qr_saas.db"
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: int = 5  # Seconds to wait for a connection before failing
+    DB_POOL_RECYCLE: int = 3600
+    DB_PGBOUNCER: bool = False  # Set when DATABASE_URL points at PgBouncer in transaction mode (port 6432)
     
     # Security
     SECRET_KEY: str = "your-secret-key-change-in-production"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     ADMIN_SETUP_KEY: str = "setup-admin-2026-change-me"  # Change in production
+    BCRYPT_ROUNDS: int = 12  # Cost factor (2^rounds key-schedule iterations)
     
     # Stripe
     STRIPE_PUBLIC_KEY: str = ""
@@ -34,21 +37,39 @@ class Settings(BaseSettings):
     STRIPE_WEBHOOK_SECRET: str = ""
     STRIPE_PRICE_ID_PRO: str = ""
     STRIPE_PRICE_ID_BUSINESS: str = ""
+    STRIPE_MAX_CONCURRENCY: int = 80  # Concurrent Stripe API calls per process
+    STRIPE_MAX_CONCURRENCY_PER_USER: int = 5
     
     # Email
     EMAIL_SERVICE: str = "sendgrid"
     SENDGRID_API_KEY: str = ""
     FROM_EMAIL: str = "noreply@qrcodepro.com"
     FROM_NAME: str = "QR Code Pro"
+    EMAIL_CAMPAIGN_CONCURRENCY: int = 20  # Parallel SendGrid requests during campaigns
+    # SendGrid Dynamic Template IDs by template name, e.g. {"welcome": "d-..."} (JSON);
+    # templates without an ID are rendered locally
+    SENDGRID_TEMPLATE_IDS: Dict[str, str] = {}
     
     # QR Code Settings
     QR_MAX_SIZE: int = 2048
     QR_DEFAULT_ERROR_CORRECTION: str = "M"
     QR_STORAGE_PATH: str = "./storage/qrcodes"
+    QR_RENDER_WORKERS: int = 0  # Render worker processes (0 = one per CPU)
+    # Internal Nginx location aliased to QR_STORAGE_PATH (e.g. "/_internal_qr/");
+    # when set, downloads are served by Nginx via X-Accel-Redirect
+    QR_ACCEL_REDIRECT_PREFIX: str = ""
     
     # Analytics
     GOOGLE_ANALYTICS_ID: Optional[str] = None
     META_PIXEL_ID: Optional[str] = None
+    # Seconds between flushes of coalesced scan counter increments (0 = update on every scan)
+    SCAN_COUNTER_FLUSH_INTERVAL: float = 0
+    
+    # Caching (seconds)
+    ADMIN_STATS_CACHE_TTL: int = 30
+    QR_LOOKUP_CACHE_TTL: int = 3600
+    QR_DYNAMIC_LOOKUP_CACHE_TTL: int = 60  # Dynamic QRs can change destination
+    STRIPE_EVENT_CACHE_TTL: int = 86400  # Window for ignoring redelivered webhook events
     
     # Rate Limiting (scans per month)
     RATE_LIMIT_FREE: int = 100
@@ -64,9 +85,7 @@ class Settings(BaseSettings):
     PLAN_PRO_PRICE: float = 9.90
     PLAN_BUSINESS_PRICE: float = 29.00
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = True
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True)
 
 
 # Global settings instance
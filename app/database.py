@@ -1,10 +1,13 @@
 """
 Database configuration and session management
 """
-from sqlalchemy import create_engine
+from sqlalchemy import DateTime, bindparam, create_engine, event, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from .config import settings
+from datetime import datetime
 import os
 
 # Use SQLite by default if DATABASE_URL is not set
@@ -13,31 +16,151 @@ if not database_url or database_url == "":
     # Use in-memory SQLite for Railway
     database_url = "sqlite:///./qr_saas.db"
 
-# Create engine
-engine = create_engine(
-    database_url,
-    connect_args={"check_same_thread": False} if "sqlite" in database_url else {}
+
+def _async_database_url(url: str) -> str:
+    """Map a sync database URL to its asyncio driver (aiosqlite / asyncpg)"""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    if url.startswith("postgresql:"):
+        return url.replace("postgresql:", "postgresql+asyncpg:", 1)
+    return url
+
+
+# Engine options shared by the sync and async engines
+if database_url.startswith("sqlite"):
+    engine_options = {
+        "connect_args": {"check_same_thread": False},
+        "pool_size": 5,
+        "max_overflow": 0,
+        "insertmanyvalues_page_size": 1000,
+    }
+    # aiosqlite defaults to NullPool; keep connections (and their PRAGMAs) pooled
+    sync_engine_options = {}
+    async_engine_options = {"poolclass": AsyncAdaptedQueuePool}
+else:
+    # PostgreSQL: size the pool for concurrent requests and fail fast when exhausted
+    engine_options = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "pool_use_lifo": True,
+        "insertmanyvalues_page_size": 1000,
+    }
+    # psycopg2 only: batch executemany() statements that can't use multi-row VALUES
+    sync_engine_options = {"executemany_mode": "values_plus_batch"}
+    async_engine_options = {}
+    if settings.DB_PGBOUNCER:
+        # Transaction-mode PgBouncer can't share server-side prepared statements between clients
+        async_engine_options["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+        }
+
+# Create engines (sync for scripts and table creation, async for request handlers)
+engine = create_engine(database_url, **engine_options, **sync_engine_options)
+async_engine = create_async_engine(
+    _async_database_url(database_url),
+    **engine_options,
+    **async_engine_options
 )
 
-# Session factory
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL and relaxed fsync so scan inserts don't serialize readers"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.execute("PRAGMA cache_size=-64000")  # 64 MB
+    cursor.close()
+
+
+if "sqlite" in database_url:
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+# Session factories
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 # Base class for models
 Base = declarative_base()
 
 
-def get_db():
+async def get_db():
     """
     Dependency for getting database session
-    Usage: db: Session = Depends(get_db)
+    Usage: db: AsyncSession = Depends(get_db)
     """
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+def _backfill_qr_code_count(conn) -> None:
+    """Seed users.qr_code_count from the QR codes each user already owns"""
+    conn.execute(text(
+        "UPDATE users SET qr_code_count = "
+        "(SELECT count(*) FROM qr_codes WHERE qr_codes.user_id = users.id)"
+    ))
+
+
+def _backfill_monthly_scans(conn) -> None:
+    """Seed the rolling monthly scan counters from this month's recorded scans"""
+    from .models.qrcode import scan_month_key
+    now = datetime.utcnow()
+    conn.execute(
+        text(
+            "UPDATE qr_codes SET scans_month_key = :month_key, scans_current_month = "
+            "(SELECT count(*) FROM qr_scans WHERE qr_scans.qr_code_id = qr_codes.id "
+            "AND qr_scans.scanned_at >= :month_start)"
+        ).bindparams(bindparam("month_start", type_=DateTime())),
+        {
+            "month_key": scan_month_key(now),
+            "month_start": now.replace(day=1, hour=0, minute=0, second=0, microsecond=0),
+        }
+    )
+
+
+# Columns added to tables that already exist in deployed databases: create_all()
+# never alters existing tables, so init_db() adds them (and seeds their values)
+_ADDED_COLUMNS = [
+    ("qr_codes", "scans_current_month", "INTEGER DEFAULT 0", None),
+    ("qr_codes", "scans_month_key", "INTEGER", _backfill_monthly_scans),
+    ("users", "qr_code_count", "INTEGER NOT NULL DEFAULT 0", _backfill_qr_code_count),
+]
+
+
+def _add_missing_columns(conn) -> None:
+    """Add columns introduced after a table was first created, then backfill them"""
+    inspector = inspect(conn)
+    existing = {}
+    for table, column, ddl, backfill in _ADDED_COLUMNS:
+        if table not in existing:
+            existing[table] = {col["name"] for col in inspector.get_columns(table)}
+        if column in existing[table]:
+            continue
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        existing[table].add(column)
+        if backfill:
+            backfill(conn)
 
 
 def init_db():
-    """Initialize database - create all tables"""
+    """Initialize database - create all tables and add any missing columns"""
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _add_missing_columns(conn)
+
+
+async def warm_up_pool():
+    """Open the pooled connections up front so first requests skip connect/auth"""
+    connections = [await async_engine.connect() for _ in range(async_engine.pool.size())]
+    try:
+        for conn in connections:
+            await conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            await conn.close()
@@ -4,12 +4,13 @@ Main FastAPI Application
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from contextlib import asynccontextmanager
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from contextlib import asynccontextmanager, suppress
+import asyncio
 import os
 
 from .config import settings
-from .database import init_db
+from .database import init_db, warm_up_pool, async_engine, AsyncSessionLocal
 from .routes import (
     auth_router,
     qr_router,
@@ -19,6 +20,11 @@ from .routes import (
     admin_router,
     setup_router
 )
+from .routes.admin import compute_platform_stats
+from .services.analytics import scan_counters
+from .services.email import email_service
+from .services.qr_generator import shutdown_render_pool
+from .services.stripe_service import StripeService
 
 
 @asynccontextmanager
@@ -31,14 +37,39 @@ async def lifespan(app: FastAPI):
     init_db()
     print("✅ Database initialized")
     
+    # Open pooled connections and prime the admin stats cache
+    await warm_up_pool()
+    async with AsyncSessionLocal() as db:
+        await compute_platform_stats(db)
+    print("✅ Connection pool and caches warmed up")
+    
     # Create storage directories
     os.makedirs(settings.QR_STORAGE_PATH, exist_ok=True)
     print(f"✅ Storage path created: {settings.QR_STORAGE_PATH}")
     
+    # Outbound API client pools (Stripe is shared by requests via get_stripe_service)
+    await email_service.startup()
+    app.state.stripe_service = StripeService()
+    await app.state.stripe_service.startup()
+    
+    # Periodically flush coalesced scan counters
+    counter_flusher = None
+    if settings.SCAN_COUNTER_FLUSH_INTERVAL > 0:
+        counter_flusher = asyncio.create_task(scan_counters.run(settings.SCAN_COUNTER_FLUSH_INTERVAL))
+    
     yield
     
     # Shutdown
     print("👋 Shutting down...")
+    if counter_flusher:
+        counter_flusher.cancel()
+        with suppress(asyncio.CancelledError):
+            await counter_flusher
+        await scan_counters.flush()
+    await email_service.shutdown()
+    await app.state.stripe_service.shutdown()
+    shutdown_render_pool()
+    await async_engine.dispose()
 
 
 # Create FastAPI app
@@ -46,6 +77,7 @@ app = FastAPI(
     title=settings.APP_NAME,
     version=settings.APP_VERSION,
     description="QR Code Generator SaaS Platform with Analytics and Marketplace",
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -3,7 +3,7 @@ Models package initialization
 """
 from .user import User, UserRole, SubscriptionPlan
 from .qrcode import QRCode
-from .analytics import QRScan
+from .analytics import QRScan, QRCountryCount, QRDeviceCount
 from .template import Template, TemplateCategory, TemplatePurchase
 
 __all__ = [
@@ -12,6 +12,8 @@ __all__ = [
     "SubscriptionPlan",
     "QRCode",
     "QRScan",
+    "QRCountryCount",
+    "QRDeviceCount",
     "Template",
     "TemplateCategory",
     "TemplatePurchase",
@@ -1,7 +1,7 @@
 """
 Analytics Model - QR Code Scans
 """
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database import Base
@@ -11,11 +11,11 @@ class QRScan(Base):
     """QR Code scan analytics model"""
     __tablename__ = "qr_scans"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     qr_code_id = Column(Integer, ForeignKey("qr_codes.id"), nullable=False)
     
     # Scan Information
-    scanned_at = Column(DateTime, default=datetime.utcnow, index=True)
+    scanned_at = Column(DateTime, default=datetime.utcnow)
     
     # Location Data
     ip_address = Column(String, nullable=True)
@@ -38,3 +38,31 @@ class QRScan(Base):
     
     def __repr__(self):
         return f"<QRScan {self.id} for QR {self.qr_code_id} at {self.scanned_at}>"
+
+
+class QRCountryCount(Base):
+    """Per-QR scan counter by country (rollup maintained at scan time)"""
+    __tablename__ = "qr_country_counts"
+    
+    qr_code_id = Column(Integer, ForeignKey("qr_codes.id"), primary_key=True)
+    country = Column(String, primary_key=True)
+    scans = Column(Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f"<QRCountryCount QR {self.qr_code_id} {self.country}: {self.scans}>"
+
+
+class QRDeviceCount(Base):
+    """Per-QR scan counter by device type (rollup maintained at scan time)"""
+    __tablename__ = "qr_device_counts"
+    
+    qr_code_id = Column(Integer, ForeignKey("qr_codes.id"), primary_key=True)
+    device_type = Column(String, primary_key=True)
+    scans = Column(Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f"<QRDeviceCount QR {self.qr_code_id} {self.device_type}: {self.scans}>"
+
+
+# Per-QR time-range lookups (analytics counts, recent scans) seek on this index
+Index("ix_qr_scans_qr_scanned", QRScan.qr_code_id, QRScan.scanned_at.desc())
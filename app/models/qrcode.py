@@ -1,17 +1,26 @@
 """
 QR Code Model
 """
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, JSON
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, JSON, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database import Base
+from app.config import settings
+
+# Public scan URL, built once from settings
+_SCAN_URL_TEMPLATE = f"{settings.APP_URL}/s/{{}}"
+
+
+def scan_month_key(moment: datetime) -> int:
+    """Month bucket (YYYYMM) used by the rolling monthly scan counter"""
+    return moment.year * 100 + moment.month
 
 
 class QRCode(Base):
     """QR Code model"""
     __tablename__ = "qr_codes"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Null for anonymous
     
     # QR Code Data
@@ -42,6 +51,8 @@ class QRCode(Base):
     # Analytics summary (cached)
     total_scans = Column(Integer, default=0)
     last_scanned_at = Column(DateTime, nullable=True)
+    scans_current_month = Column(Integer, default=0)
+    scans_month_key = Column(Integer, nullable=True)  # YYYYMM the counter above belongs to
     
     # Timestamps
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -50,6 +61,8 @@ class QRCode(Base):
     # Relationships
     owner = relationship("User", back_populates="qr_codes")
     scans = relationship("QRScan", back_populates="qr_code", cascade="all, delete-orphan")
+    country_counts = relationship("QRCountryCount", cascade="all, delete-orphan")
+    device_counts = relationship("QRDeviceCount", cascade="all, delete-orphan")
     
     def __repr__(self):
         return f"<QRCode {self.short_code}: {self.title}>"
@@ -57,8 +70,7 @@ class QRCode(Base):
     @property
     def scan_url(self):
         """Get the public scan URL"""
-        from app.config import settings
-        return f"{settings.APP_URL}/s/{self.short_code}"
+        return _SCAN_URL_TEMPLATE.format(self.short_code)
     
     @property
     def is_expired(self):
@@ -71,3 +83,10 @@ class QRCode(Base):
     def can_scan(self):
         """Check if QR code can be scanned"""
         return self.is_active and not self.is_expired
+
+
+# Most-scanned lookups per user seek on this index
+Index("ix_qr_user_scans", QRCode.user_id, QRCode.total_scans)
+
+# Newest-first listing of a user's QR codes reads this index in order
+Index("ix_qr_user_created", QRCode.user_id, QRCode.created_at.desc())
@@ -11,7 +11,7 @@ class TemplateCategory(Base):
     """Template category model"""
     __tablename__ = "template_categories"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, nullable=False)
     slug = Column(String, unique=True, nullable=False)
     description = Column(Text, nullable=True)
@@ -29,7 +29,7 @@ class Template(Base):
     """QR Code template model for marketplace"""
     __tablename__ = "templates"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     creator_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     category_id = Column(Integer, ForeignKey("template_categories.id"), nullable=True)
     
@@ -82,7 +82,7 @@ class TemplatePurchase(Base):
     """Template purchase tracking"""
     __tablename__ = "template_purchases"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     template_id = Column(Integer, ForeignKey("templates.id"), nullable=False)
     
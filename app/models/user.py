@@ -25,7 +25,7 @@ class User(Base):
     """User model"""
     __tablename__ = "users"
     
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True, nullable=False)
     username = Column(String, unique=True, index=True, nullable=True)
     hashed_password = Column(String, nullable=False)
@@ -34,14 +34,21 @@ class User(Base):
     # Account status
     is_active = Column(Boolean, default=True)
     is_verified = Column(Boolean, default=False)
-    role = Column(Enum(UserRole), default=UserRole.USER)
+    role = Column(Enum(UserRole, native_enum=True, length=16), default=UserRole.USER)
     
     # Subscription
-    subscription_plan = Column(Enum(SubscriptionPlan), default=SubscriptionPlan.FREE)
+    subscription_plan = Column(
+        Enum(SubscriptionPlan, native_enum=True, length=16),
+        default=SubscriptionPlan.FREE,
+        index=True  # Per-plan counts in admin stats and email campaigns
+    )
     stripe_customer_id = Column(String, nullable=True)
     stripe_subscription_id = Column(String, nullable=True)
     subscription_ends_at = Column(DateTime, nullable=True)
     
+    # Usage
+    qr_code_count = Column(Integer, default=0, nullable=False)  # Kept in step by QR create/delete
+    
     # Timestamps
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -1,19 +1,27 @@
 """
 Admin Routes - For platform administrators
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, func
 from pydantic import BaseModel, EmailStr
 from typing import List, Optional
 from datetime import datetime
+import orjson
 
-from app.database import get_db
+from app.database import get_db, AsyncSessionLocal
 from app.models import User, QRCode, QRScan, UserRole, SubscriptionPlan
 from app.utils.auth import get_current_user
+from app.routes.public import invalidate_scan_target
+from app.utils.cache import TTLCache
+from app.config import settings
 
 router = APIRouter(prefix="/admin", tags=["Admin"])
 
+# Platform stats are the same for every admin, so a single shared entry suffices
+_stats_cache = TTLCache(ttl=settings.ADMIN_STATS_CACHE_TTL, maxsize=1)
+
 
 # Schemas
 class UserAdmin(BaseModel):
@@ -66,74 +74,119 @@ def get_current_admin(current_user: User = Depends(get_current_user)):
     return current_user
 
 
+async def compute_platform_stats(db: AsyncSession) -> PlatformStats:
+    """Compute platform statistics and refresh the stats cache"""
+    
+    # Users per plan (one grouped query)
+    plan_rows = await db.execute(
+        select(User.subscription_plan, func.count(User.id)).group_by(User.subscription_plan)
+    )
+    users_by_plan = {plan: count for plan, count in plan_rows}
+    
+    # QR code totals (one conditional-aggregate query)
+    total_qr_codes, active_qr_codes, total_scans = (await db.execute(select(
+        func.count(QRCode.id),
+        func.count(QRCode.id).filter(QRCode.is_active == True),
+        func.coalesce(func.sum(QRCode.total_scans), 0)
+    ))).one()
+    
+    stats = PlatformStats(
+        total_users=sum(users_by_plan.values()),
+        free_users=users_by_plan.get(SubscriptionPlan.FREE, 0),
+        pro_users=users_by_plan.get(SubscriptionPlan.PRO, 0),
+        business_users=users_by_plan.get(SubscriptionPlan.BUSINESS, 0),
+        total_qr_codes=total_qr_codes,
+        total_scans=total_scans,
+        active_qr_codes=active_qr_codes
+    )
+    _stats_cache.set("platform", stats)
+    return stats
+
+
 @router.get("/stats", response_model=PlatformStats)
 async def get_platform_stats(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     admin: User = Depends(get_current_admin)
 ):
-    """Get platform statistics"""
-    
-    total_users = db.query(User).count()
-    free_users = db.query(User).filter(User.subscription_plan == SubscriptionPlan.FREE).count()
-    pro_users = db.query(User).filter(User.subscription_plan == SubscriptionPlan.PRO).count()
-    business_users = db.query(User).filter(User.subscription_plan == SubscriptionPlan.BUSINESS).count()
-    
-    total_qr_codes = db.query(QRCode).count()
-    active_qr_codes = db.query(QRCode).filter(QRCode.is_active == True).count()
-    total_scans = db.query(func.sum(QRCode.total_scans)).scalar() or 0
-    
-    return PlatformStats(
-        total_users=total_users,
-        free_users=free_users,
-        pro_users=pro_users,
-        business_users=business_users,
-        total_qr_codes=total_qr_codes,
-        total_scans=total_scans,
-        active_qr_codes=active_qr_codes
+    """Get platform statistics (cached for a few seconds, stale-tolerant)"""
+    stats = _stats_cache.get("platform")
+    if stats is None:
+        stats = await compute_platform_stats(db)
+    return stats
+
+
+def _users_with_stats_query():
+    """Users with their QR stats in one LEFT JOIN aggregate (no per-user queries)"""
+    return (
+        select(
+            User,
+            func.count(QRCode.id),
+            func.coalesce(func.sum(QRCode.total_scans), 0)
+        )
+        .outerjoin(QRCode, QRCode.user_id == User.id)
+        .group_by(User.id)
+        .order_by(User.id)
+    )
+
+
+def _to_user_admin(user: User, qr_count: int, total_scans: int) -> UserAdmin:
+    """Build admin view of a user"""
+    return UserAdmin(
+        id=user.id,
+        email=user.email,
+        full_name=user.full_name,
+        subscription_plan=user.subscription_plan.value,
+        role=user.role.value,
+        is_verified=user.is_verified,
+        created_at=user.created_at,
+        total_qr_codes=qr_count,
+        total_scans=total_scans
     )
 
 
 @router.get("/users", response_model=List[UserAdmin])
 async def get_all_users(
-    skip: int = 0,
-    limit: int = 100,
-    db: Session = Depends(get_db),
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
     admin: User = Depends(get_current_admin)
 ):
-    """Get all users with stats"""
-    
-    users = db.query(User).offset(skip).limit(limit).all()
-    
-    result = []
-    for user in users:
-        qr_count = db.query(QRCode).filter(QRCode.user_id == user.id).count()
-        total_scans = db.query(func.sum(QRCode.total_scans)).filter(QRCode.user_id == user.id).scalar() or 0
-        
-        result.append(UserAdmin(
-            id=user.id,
-            email=user.email,
-            full_name=user.full_name,
-            subscription_plan=user.subscription_plan.value,
-            role=user.role.value,
-            is_verified=user.is_verified,
-            created_at=user.created_at,
-            total_qr_codes=qr_count,
-            total_scans=total_scans
-        ))
-    
-    return result
+    """Get all users with stats (paginated, max 100 per page)"""
+    
+    rows = await db.execute(_users_with_stats_query().offset(skip).limit(limit))
+    return [_to_user_admin(user, qr_count, total_scans) for user, qr_count, total_scans in rows]
+
+
+async def _export_users_jsonl():
+    """Stream every user as one JSON line, fetching rows in small batches"""
+    # Uses its own session: request dependencies are closed before the body streams
+    async with AsyncSessionLocal() as db:
+        rows = await db.stream(_users_with_stats_query().execution_options(yield_per=50))
+        async for user, qr_count, total_scans in rows:
+            user_admin = _to_user_admin(user, qr_count, total_scans)
+            yield orjson.dumps(user_admin.model_dump(mode="json")) + b"\n"
+
+
+@router.get("/users/export")
+async def export_users(admin: User = Depends(get_current_admin)):
+    """Export all users with stats as JSON Lines (constant memory)"""
+    return StreamingResponse(
+        _export_users_jsonl(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="users.jsonl"'}
+    )
 
 
 @router.put("/users/{user_id}", response_model=UserAdmin)
 async def update_user(
     user_id: int,
     user_update: UserUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     admin: User = Depends(get_current_admin)
 ):
     """Update user details (admin only)"""
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.scalar(select(User).where(User.id == user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -145,35 +198,25 @@ async def update_user(
     if user_update.is_verified is not None:
         user.is_verified = user_update.is_verified
     
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     
     # Get stats
-    qr_count = db.query(QRCode).filter(QRCode.user_id == user.id).count()
-    total_scans = db.query(func.sum(QRCode.total_scans)).filter(QRCode.user_id == user.id).scalar() or 0
+    qr_count = await db.scalar(select(func.count(QRCode.id)).where(QRCode.user_id == user.id))
+    total_scans = await db.scalar(select(func.sum(QRCode.total_scans)).where(QRCode.user_id == user.id)) or 0
     
-    return UserAdmin(
-        id=user.id,
-        email=user.email,
-        full_name=user.full_name,
-        subscription_plan=user.subscription_plan.value,
-        role=user.role.value,
-        is_verified=user.is_verified,
-        created_at=user.created_at,
-        total_qr_codes=qr_count,
-        total_scans=total_scans
-    )
+    return _to_user_admin(user, qr_count, total_scans)
 
 
 @router.delete("/users/{user_id}")
 async def delete_user(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     admin: User = Depends(get_current_admin)
 ):
     """Delete user and all their data"""
     
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.scalar(select(User).where(User.id == user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -185,10 +228,16 @@ async def delete_user(
         )
     
     # Delete user's QR codes first
-    db.query(QRCode).filter(QRCode.user_id == user_id).delete()
+    deleted_codes = await db.scalars(
+        delete(QRCode).where(QRCode.user_id == user_id).returning(QRCode.short_code)
+    )
+    short_codes = deleted_codes.all()
     
     # Delete user
-    db.delete(user)
-    db.commit()
+    await db.delete(user)
+    await db.commit()
+    
+    for short_code in short_codes:
+        invalidate_scan_target(short_code)
     
     return {"message": "User deleted successfully"}
@@ -2,22 +2,22 @@
 Analytics Routes
 """
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-from sqlalchemy import func, extract
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func, extract
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Union
 from datetime import datetime, timedelta
 from app.database import get_db
-from app.models import User, QRCode, QRScan
+from app.models import User, QRCode, QRScan, QRCountryCount, QRDeviceCount
+from app.models.qrcode import scan_month_key
 from app.utils.auth import get_current_user
-import user_agents
 
 router = APIRouter(prefix="/analytics", tags=["Analytics"])
 
 
 # Schemas
 class ScanEvent(BaseModel):
-    timestamp: str
+    timestamp: datetime
     country: str | None
     city: str | None
     device_type: str | None
@@ -30,8 +30,8 @@ class QRAnalytics(BaseModel):
     scans_today: int
     scans_this_week: int
     scans_this_month: int
-    top_countries: List[Dict[str, int]]
-    top_devices: List[Dict[str, int]]
+    top_countries: List[Dict[str, Union[str, int]]]
+    top_devices: List[Dict[str, Union[str, int]]]
     recent_scans: List[ScanEvent]
 
 
@@ -39,15 +39,15 @@ class QRAnalytics(BaseModel):
 async def get_qr_analytics(
     qr_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get analytics for specific QR code"""
     
     # Verify ownership
-    qr_code = db.query(QRCode).filter(
+    qr_code = await db.scalar(select(QRCode).where(
         QRCode.id == qr_id,
         QRCode.user_id == current_user.id
-    ).first()
+    ))
     
     if not qr_code:
         raise HTTPException(status_code=404, detail="QR code not found")
@@ -65,49 +65,34 @@ async def get_qr_analytics(
     week_ago = now - timedelta(days=7)
     month_ago = now - timedelta(days=30)
     
-    # Total scans
-    total_scans = db.query(QRScan).filter(QRScan.qr_code_id == qr_id).count()
-    
-    # Scans today
-    scans_today = db.query(QRScan).filter(
-        QRScan.qr_code_id == qr_id,
-        QRScan.scanned_at >= today
-    ).count()
-    
-    # Scans this week
-    scans_week = db.query(QRScan).filter(
-        QRScan.qr_code_id == qr_id,
-        QRScan.scanned_at >= week_ago
-    ).count()
-    
-    # Scans this month
-    scans_month = db.query(QRScan).filter(
-        QRScan.qr_code_id == qr_id,
-        QRScan.scanned_at >= month_ago
-    ).count()
-    
-    # Top countries
-    top_countries = db.query(
-        QRScan.country,
-        func.count(QRScan.id).label('count')
-    ).filter(
-        QRScan.qr_code_id == qr_id,
-        QRScan.country.isnot(None)
-    ).group_by(QRScan.country).order_by(func.count(QRScan.id).desc()).limit(5).all()
-    
-    # Top devices
-    top_devices = db.query(
-        QRScan.device_type,
-        func.count(QRScan.id).label('count')
-    ).filter(
-        QRScan.qr_code_id == qr_id,
-        QRScan.device_type.isnot(None)
-    ).group_by(QRScan.device_type).order_by(func.count(QRScan.id).desc()).limit(5).all()
+    # Total / today / week / month scans in a single conditional-aggregate query
+    total_scans, scans_today, scans_week, scans_month = (await db.execute(select(
+        func.count(QRScan.id),
+        func.count(QRScan.id).filter(QRScan.scanned_at >= today),
+        func.count(QRScan.id).filter(QRScan.scanned_at >= week_ago),
+        func.count(QRScan.id).filter(QRScan.scanned_at >= month_ago)
+    ).where(QRScan.qr_code_id == qr_id))).one()
+    
+    # Top countries (from rollup counters)
+    top_countries = (await db.execute(select(
+        QRCountryCount.country,
+        QRCountryCount.scans
+    ).where(
+        QRCountryCount.qr_code_id == qr_id
+    ).order_by(QRCountryCount.scans.desc()).limit(5))).all()
+    
+    # Top devices (from rollup counters)
+    top_devices = (await db.execute(select(
+        QRDeviceCount.device_type,
+        QRDeviceCount.scans
+    ).where(
+        QRDeviceCount.qr_code_id == qr_id
+    ).order_by(QRDeviceCount.scans.desc()).limit(5))).all()
     
     # Recent scans (last 10)
-    recent_scans = db.query(QRScan).filter(
+    recent_scans = (await db.scalars(select(QRScan).where(
         QRScan.qr_code_id == qr_id
-    ).order_by(QRScan.scanned_at.desc()).limit(10).all()
+    ).order_by(QRScan.scanned_at.desc()).limit(10))).all()
     
     return {
         "qr_code_id": qr_id,
@@ -119,7 +104,7 @@ async def get_qr_analytics(
         "top_devices": [{"device": d[0], "count": d[1]} for d in top_devices],
         "recent_scans": [
             {
-                "timestamp": scan.scanned_at.isoformat(),
+                "timestamp": scan.scanned_at,
                 "country": scan.country,
                 "city": scan.city,
                 "device_type": scan.device_type,
@@ -133,39 +118,30 @@ async def get_qr_analytics(
 @router.get("/dashboard/summary")
 async def get_dashboard_summary(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get summary analytics for user dashboard"""
     
-    # Get all user's QR codes
-    qr_codes = db.query(QRCode).filter(QRCode.user_id == current_user.id).all()
-    qr_ids = [qr.id for qr in qr_codes]
-    
-    # Total QR codes
-    total_qr_codes = len(qr_codes)
-    
-    # Total scans across all QR codes
-    total_scans = db.query(QRScan).filter(QRScan.qr_code_id.in_(qr_ids)).count() if qr_ids else 0
-    
-    # Scans this month
-    month_ago = datetime.utcnow() - timedelta(days=30)
-    scans_this_month = db.query(QRScan).filter(
-        QRScan.qr_code_id.in_(qr_ids),
-        QRScan.scanned_at >= month_ago
-    ).count() if qr_ids else 0
+    # QR count, lifetime scans and this month's scans from the cached counters
+    month_key = scan_month_key(datetime.utcnow())
+    total_qr_codes, total_scans, scans_this_month = (await db.execute(select(
+        func.count(QRCode.id),
+        func.coalesce(func.sum(QRCode.total_scans), 0),
+        func.coalesce(func.sum(QRCode.scans_current_month).filter(QRCode.scans_month_key == month_key), 0)
+    ).where(QRCode.user_id == current_user.id))).one()
     
     # Most scanned QR
     most_scanned = None
-    if qr_ids:
-        top_qr = db.query(
+    if total_qr_codes:
+        top_qr = (await db.execute(select(
             QRCode.id,
             QRCode.title,
-            func.count(QRScan.id).label('scan_count')
-        ).join(QRScan).filter(
-            QRCode.id.in_(qr_ids)
-        ).group_by(QRCode.id, QRCode.title).order_by(func.count(QRScan.id).desc()).first()
+            QRCode.total_scans
+        ).where(
+            QRCode.user_id == current_user.id
+        ).order_by(QRCode.total_scans.desc()).limit(1))).first()
         
-        if top_qr:
+        if top_qr and top_qr[2]:
             most_scanned = {
                 "id": top_qr[0],
                 "title": top_qr[1],
@@ -1,18 +1,23 @@
 """
 Payment Routes (Stripe Integration)
 """
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from app.database import get_db
 from app.models import User
 from app.utils.auth import get_current_user
-from app.services.stripe_service import stripe_service
+from app.services.stripe_service import StripeAPIError, StripeService, TooManyStripeRequests, get_stripe_service
 from app.services.email import email_service
+from app.utils.cache import TTLCache
 from app.config import settings
+import orjson
 
 router = APIRouter(prefix="/payments", tags=["Payments"])
 
+# Stripe event IDs already handled (Stripe may deliver an event more than once)
+_processed_events = TTLCache(ttl=settings.STRIPE_EVENT_CACHE_TTL, maxsize=10000)
+
 
 class CheckoutRequest(BaseModel):
     plan: str  # "pro" or "business"
@@ -27,7 +32,8 @@ class CheckoutResponse(BaseModel):
 async def create_checkout_session(
     checkout_data: CheckoutRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    stripe_service: StripeService = Depends(get_stripe_service)
 ):
     """Create Stripe checkout session for subscription"""
     
@@ -35,23 +41,32 @@ async def create_checkout_session(
         raise HTTPException(status_code=400, detail="Invalid plan")
     
     # Create checkout session
-    session = await stripe_service.create_checkout_session(
-        user=current_user,
-        plan=checkout_data.plan,
-        success_url=f"{settings.FRONTEND_URL}/payment/success?session_id={{CHECKOUT_SESSION_ID}}",
-        cancel_url=f"{settings.FRONTEND_URL}/pricing?canceled=true"
-    )
-    
-    # Update user's Stripe customer ID if created
-    if not current_user.stripe_customer_id:
-        db.commit()
+    try:
+        async with stripe_service.user_slot(current_user.id):
+            session = await stripe_service.create_checkout_session(
+                user=current_user,
+                plan=checkout_data.plan,
+                success_url=f"{settings.FRONTEND_URL}/payment/success?session_id={{CHECKOUT_SESSION_ID}}",
+                cancel_url=f"{settings.FRONTEND_URL}/pricing?canceled=true"
+            )
+    except TooManyStripeRequests:
+        raise HTTPException(status_code=429, detail="Too many payment requests in progress")
+    except StripeAPIError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Persist the Stripe customer ID if one was just created
+    if current_user in db.dirty:
+        await db.commit()
     
     return session
 
 
 @router.post("/create-portal-session")
 async def create_portal_session(
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_user),
+    stripe_service: StripeService = Depends(get_stripe_service)
 ):
     """Create Stripe customer portal session for managing subscription"""
     
@@ -61,16 +76,27 @@ async def create_portal_session(
             detail="No active subscription found"
         )
     
-    portal_url = await stripe_service.create_portal_session(
-        user=current_user,
-        return_url=f"{settings.FRONTEND_URL}/dashboard"
-    )
+    try:
+        async with stripe_service.user_slot(current_user.id):
+            portal_url = await stripe_service.create_portal_session(
+                user=current_user,
+                return_url=f"{settings.FRONTEND_URL}/dashboard"
+            )
+    except TooManyStripeRequests:
+        raise HTTPException(status_code=429, detail="Too many payment requests in progress")
+    except StripeAPIError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     
     return {"url": portal_url}
 
 
 @router.post("/webhook")
-async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
+async def stripe_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db),
+    stripe_service: StripeService = Depends(get_stripe_service)
+):
     """Handle Stripe webhooks"""
     
     payload = await request.body()
@@ -81,6 +107,11 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     
+    # Skip redelivered events
+    event_id = event["id"]
+    if _processed_events.get(event_id):
+        return {"status": "duplicate"}
+    
     # Handle different event types
     event_type = event["type"]
     event_data = event["data"]["object"]
@@ -88,87 +119,88 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
     if event_type == "checkout.session.completed":
         # Payment successful
         session = event_data
-        user_id = session.get("metadata", {}).get("user_id")
+        user_email = await stripe_service.handle_checkout_completed(session, db)
         
-        if user_id:
-            user = db.query(User).filter(User.id == int(user_id)).first()
-            if user:
-                await stripe_service.handle_checkout_completed(session, user)
-                db.commit()
-                
-                # Send confirmation email
-                plan = session.get("metadata", {}).get("plan", "PRO")
-                await email_service.send_subscription_confirmation(
-                    to_email=user.email,
-                    plan=plan
-                )
+        if user_email:
+            await db.commit()
+            
+            # Send confirmation email after acknowledging the webhook
+            plan = session.get("metadata", {}).get("plan", "PRO")
+            background_tasks.add_task(
+                email_service.send_subscription_confirmation,
+                to_email=user_email,
+                plan=plan
+            )
     
     elif event_type == "customer.subscription.updated":
         # Subscription updated
-        await stripe_service.handle_subscription_updated(event_data)
-        db.commit()
+        await stripe_service.handle_subscription_updated(event_data, db)
+        await db.commit()
     
     elif event_type == "customer.subscription.deleted":
-        # Subscription canceled
-        subscription_id = event_data["id"]
-        user = db.query(User).filter(User.stripe_subscription_id == subscription_id).first()
-        
-        if user:
-            await stripe_service.handle_subscription_deleted(event_data, user)
-            db.commit()
+        # Subscription canceled (a no-op UPDATE if no user has this subscription)
+        await stripe_service.handle_subscription_deleted(event_data, db)
+        await db.commit()
+    
+    # Only mark as processed once handled, so failed deliveries are retried
+    _processed_events.set(event_id, True)
     
     return {"status": "success"}
 
 
+# Plans are static (derived from settings), so serialize once at import
+_PLANS_JSON = orjson.dumps({
+    "plans": [
+        {
+            "id": "free",
+            "name": "FREE",
+            "price": 0,
+            "currency": "EUR",
+            "interval": "month",
+            "features": [
+                "3 QR codes",
+                "100 scans/month",
+                "Basic customization",
+                "PNG download"
+            ]
+        },
+        {
+            "id": "pro",
+            "name": "PRO",
+            "price": settings.PLAN_PRO_PRICE,
+            "currency": "EUR",
+            "interval": "month",
+            "features": [
+                "Unlimited QR codes",
+                "Unlimited scans",
+                "Full customization",
+                "Dynamic QR codes",
+                "Advanced analytics",
+                "PNG, SVG, PDF export",
+                "API access"
+            ],
+            "popular": True
+        },
+        {
+            "id": "business",
+            "name": "BUSINESS",
+            "price": settings.PLAN_BUSINESS_PRICE,
+            "currency": "EUR",
+            "interval": "month",
+            "features": [
+                "Everything in PRO",
+                "White label",
+                "Team collaboration",
+                "Priority support",
+                "Custom domain",
+                "SLA guarantee"
+            ]
+        }
+    ]
+})
+
+
 @router.get("/plans")
 async def get_plans():
     """Get available subscription plans"""
-    return {
-        "plans": [
-            {
-                "id": "free",
-                "name": "FREE",
-                "price": 0,
-                "currency": "EUR",
-                "interval": "month",
-                "features": [
-                    "3 QR codes",
-                    "100 scans/month",
-                    "Basic customization",
-                    "PNG download"
-                ]
-            },
-            {
-                "id": "pro",
-                "name": "PRO",
-                "price": settings.PLAN_PRO_PRICE,
-                "currency": "EUR",
-                "interval": "month",
-                "features": [
-                    "Unlimited QR codes",
-                    "Unlimited scans",
-                    "Full customization",
-                    "Dynamic QR codes",
-                    "Advanced analytics",
-                    "PNG, SVG, PDF export",
-                    "API access"
-                ],
-                "popular": True
-            },
-            {
-                "id": "business",
-                "name": "BUSINESS",
-                "price": settings.PLAN_BUSINESS_PRICE,
-                "currency": "EUR",
-                "interval": "month",
-                "features": [
-                    "Everything in PRO",
-                    "White label",
-                    "Team collaboration",
-                    "Priority support",
-                    "Custom domain",
-                    "SLA guarantee"
-                ]
-            }
-        ]
-    }
+    return Response(content=_PLANS_JSON, media_type="application/json")
@@ -1,30 +1,75 @@
 """
 Public Routes (No authentication required)
 """
-from fastapi import APIRouter, Depends, Request, Response
+from fastapi import APIRouter, BackgroundTasks, Depends, Request, Response
 from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
-from app.models import QRCode, QRScan
+from app.models import QRCode
+from app.services.analytics import record_scan, parse_user_agent
+from app.utils.cache import TTLCache
+from app.config import settings
 from datetime import datetime
-import user_agents
+from typing import NamedTuple, Optional
 
 router = APIRouter(tags=["Public"])
 
 
+class ScanTarget(NamedTuple):
+    """Minimal QR code data needed to serve a scan"""
+    id: int
+    destination_url: str
+    is_active: bool
+    expires_at: Optional[datetime]
+    
+    @property
+    def can_scan(self):
+        """Check if QR code can be scanned"""
+        return self.is_active and not (self.expires_at and datetime.utcnow() > self.expires_at)
+
+
+_scan_target_cache = TTLCache(ttl=settings.QR_LOOKUP_CACHE_TTL, maxsize=10000)
+
+
+def invalidate_scan_target(short_code: str) -> None:
+    """Drop cached scan data after a QR code is changed or deleted"""
+    _scan_target_cache.delete(short_code)
+
+
+async def get_scan_target(db: AsyncSession, short_code: str) -> Optional[ScanTarget]:
+    """Look up a QR code by short code, read-through cached"""
+    target = _scan_target_cache.get(short_code)
+    if target is not None:
+        return target
+    
+    row = (await db.execute(
+        select(QRCode.id, QRCode.destination_url, QRCode.is_active, QRCode.expires_at, QRCode.is_dynamic)
+        .where(QRCode.short_code == short_code)
+    )).first()
+    if row is None:
+        return None
+    
+    target = ScanTarget(row.id, row.destination_url, row.is_active, row.expires_at)
+    ttl = settings.QR_DYNAMIC_LOOKUP_CACHE_TTL if row.is_dynamic else None
+    _scan_target_cache.set(short_code, target, ttl=ttl)
+    return target
+
+
 @router.get("/s/{short_code}")
 async def scan_qr_code(
     short_code: str,
     request: Request,
-    db: Session = Depends(get_db)
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Public endpoint for QR code scanning
-    Redirects to destination URL and tracks analytics
+    Redirects to destination URL; analytics are recorded after the response
     """
     
     # Find QR code
-    qr_code = db.query(QRCode).filter(QRCode.short_code == short_code).first()
+    qr_code = await get_scan_target(db, short_code)
     
     if not qr_code:
         return Response(status_code=404, content="QR code not found")
@@ -38,42 +83,26 @@ async def scan_qr_code(
     
     # Extract analytics data
     user_agent_string = request.headers.get("user-agent", "")
-    ua = user_agents.parse(user_agent_string)
+    device = parse_user_agent(user_agent_string)
     
     # Get client IP (handle proxies)
     client_ip = request.client.host
     if "x-forwarded-for" in request.headers:
         client_ip = request.headers["x-forwarded-for"].split(",")[0].strip()
     
-    # Determine device type
-    if ua.is_mobile:
-        device_type = "mobile"
-    elif ua.is_tablet:
-        device_type = "tablet"
-    elif ua.is_pc:
-        device_type = "desktop"
-    else:
-        device_type = "other"
-    
-    # Create scan record
-    scan = QRScan(
+    # Record scan and update QR code stats off the request path
+    background_tasks.add_task(
+        record_scan,
         qr_code_id=qr_code.id,
         ip_address=client_ip,
         user_agent=user_agent_string,
-        device_type=device_type,
-        os=ua.os.family if ua.os.family else None,
-        browser=ua.browser.family if ua.browser.family else None,
-        referrer=request.headers.get("referer")
+        device_type=device.device_type,
+        os=device.os,
+        browser=device.browser,
+        referrer=request.headers.get("referer"),
+        scanned_at=datetime.utcnow()
     )
     
-    db.add(scan)
-    
-    # Update QR code stats
-    qr_code.total_scans += 1
-    qr_code.last_scanned_at = datetime.utcnow()
-    
-    db.commit()
-    
     # Redirect to destination
     return RedirectResponse(url=qr_code.destination_url, status_code=302)
 
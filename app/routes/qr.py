@@ -1,18 +1,33 @@
 """
 QR Code Routes
 """
-from fastapi import APIRouter, Depends, HTTPException, status, Response, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Query, status, Response, BackgroundTasks
 from fastapi.responses import FileResponse, StreamingResponse
-from sqlalchemy.orm import Session
-from pydantic import BaseModel, HttpUrl, ConfigDict
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel, HttpUrl, ConfigDict, field_validator
+from PIL import ImageColor
 from typing import Optional, List
 from datetime import datetime
 import secrets
+import string
 import io
-from app.database import get_db
+import os
+from urllib.parse import quote
+from app.config import settings
+from app.database import get_db, AsyncSessionLocal
 from app.models import User, QRCode, QRScan
+from app.models.qrcode import _SCAN_URL_TEMPLATE
 from app.utils.auth import get_current_user
 from app.services.qr_generator import qr_generator
+from app.routes.public import invalidate_scan_target
+
+# Short codes: 8 random base62 chars (~47 bits); collisions are astronomically
+# rare, so give up after a few
+BASE62_ALPHABET = string.digits + string.ascii_letters
+SHORT_CODE_LENGTH = 8
+SHORT_CODE_ATTEMPTS = 3
 
 router = APIRouter(prefix="/qr", tags=["QR Codes"])
 
@@ -26,6 +41,11 @@ class QRCodeCreate(BaseModel):
     background_color: str = "#FFFFFF"
     style: str = "square"
     logo_path: Optional[str] = None
+    
+    @field_validator("foreground_color", "background_color")
+    @classmethod
+    def check_color(cls, value: str) -> str:
+        return _check_color(value)
 
 
 class QRCodeUpdate(BaseModel):
@@ -34,6 +54,11 @@ class QRCodeUpdate(BaseModel):
     foreground_color: Optional[str] = None
     background_color: Optional[str] = None
     is_active: Optional[bool] = None
+    
+    @field_validator("foreground_color", "background_color")
+    @classmethod
+    def check_color(cls, value: Optional[str]) -> Optional[str]:
+        return value if value is None else _check_color(value)
 
 
 class QRCodeResponse(BaseModel):
@@ -53,75 +78,132 @@ class QRCodeResponse(BaseModel):
     created_at: datetime
 
 
+# Columns needed by the list view (no file paths or metadata)
+_LIST_COLUMNS = (
+    QRCode.id,
+    QRCode.title,
+    QRCode.destination_url,
+    QRCode.short_code,
+    QRCode.is_dynamic,
+    QRCode.is_active,
+    QRCode.total_scans,
+    QRCode.foreground_color,
+    QRCode.background_color,
+    QRCode.style,
+    QRCode.created_at,
+)
+
+
+def _check_color(value: str) -> str:
+    """Reject colours the renderer can't parse (they would fail after the 201)"""
+    try:
+        ImageColor.getrgb(value)
+    except ValueError:
+        raise ValueError(f"Invalid color: {value}")
+    return value
+
+
 def generate_short_code() -> str:
-    """Generate unique short code for QR"""
-    return secrets.token_urlsafe(6)
+    """Generate random base62 short code for QR (uniqueness enforced on insert)"""
+    return "".join(secrets.choice(BASE62_ALPHABET) for _ in range(SHORT_CODE_LENGTH))
+
+
+async def generate_qr_files(qr_code: QRCode) -> Optional[dict]:
+    """Render and store QR images, then record their paths (None if rendering failed)"""
+    try:
+        file_paths = await qr_generator.generate_and_save_async(
+            qr_code.short_code,
+            qr_code.scan_url,  # Encode the tracking URL, not the destination
+            foreground_color=qr_code.foreground_color,
+            background_color=qr_code.background_color,
+            style=qr_code.style,
+            logo_path=qr_code.logo_path
+        )
+    except Exception as e:
+        # Paths stay NULL; the download route renders again on demand
+        print(f"[QR RENDER ERROR] qr_id={qr_code.id}: {e!r}")
+        return None
+    
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(QRCode)
+            .where(QRCode.id == qr_code.id)
+            .values(
+                file_path_png=file_paths["png"],
+                file_path_svg=file_paths["svg"],
+                file_path_pdf=file_paths["pdf"]
+            )
+        )
+        await db.commit()
+    return file_paths
 
 
 @router.post("/create", response_model=QRCodeResponse, status_code=status.HTTP_201_CREATED)
 async def create_qr_code(
     qr_data: QRCodeCreate,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create new QR code"""
     
-    # Check user's QR limit (for FREE users)
+    # Claim a slot with an atomic increment; for FREE users the WHERE enforces the
+    # QR limit, so concurrent creates cannot both pass it
+    claim = (
+        update(User)
+        .where(User.id == current_user.id)
+        .values(qr_code_count=User.qr_code_count + 1)
+        .returning(User.qr_code_count)
+        .execution_options(synchronize_session="fetch")
+    )
     if not current_user.is_premium:
-        qr_count = db.query(QRCode).filter(QRCode.user_id == current_user.id).count()
-        if qr_count >= current_user.qr_code_limit:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail=f"Free plan limited to {current_user.qr_code_limit} QR codes. Upgrade to PRO for unlimited."
-            )
+        claim = claim.where(User.qr_code_count < current_user.qr_code_limit)
+    qr_count = await db.scalar(claim)
+    if qr_count is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Free plan limited to {current_user.qr_code_limit} QR codes. Upgrade to PRO for unlimited."
+        )
     
-    # Generate unique short code
-    short_code = generate_short_code()
-    while db.query(QRCode).filter(QRCode.short_code == short_code).first():
-        short_code = generate_short_code()
-    
-    # Generate tracking URL
-    from app.config import settings
-    tracking_url = f"{settings.APP_URL}/s/{short_code}"
-    
-    # Generate QR code images with tracking URL
-    png_bytes, svg_bytes, pdf_bytes = qr_generator.generate(
-        data=tracking_url,  # Use tracking URL instead of destination
-        foreground_color=qr_data.foreground_color,
-        background_color=qr_data.background_color,
-        style=qr_data.style,
-        logo_path=qr_data.logo_path
-    )
+    # Create database record, claiming a unique short code (the UNIQUE constraint
+    # rejects the rare collision, so no lookup is needed beforehand)
+    for _ in range(SHORT_CODE_ATTEMPTS):
+        new_qr = QRCode(
+            user_id=current_user.id,
+            title=qr_data.title,
+            destination_url=str(qr_data.destination_url),
+            short_code=generate_short_code(),
+            is_dynamic=qr_data.is_dynamic,
+            foreground_color=qr_data.foreground_color,
+            background_color=qr_data.background_color,
+            style=qr_data.style,
+            logo_path=qr_data.logo_path
+        )
+        try:
+            async with db.begin_nested():
+                db.add(new_qr)
+            break
+        except IntegrityError:
+            continue
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not allocate a short code, please retry"
+        )
     
-    # Save files
-    file_paths = qr_generator.save_files(short_code, png_bytes, svg_bytes, pdf_bytes)
-    
-    # Create database record
-    new_qr = QRCode(
-        user_id=current_user.id,
-        title=qr_data.title,
-        destination_url=str(qr_data.destination_url),
-        short_code=short_code,
-        is_dynamic=qr_data.is_dynamic,
-        foreground_color=qr_data.foreground_color,
-        background_color=qr_data.background_color,
-        style=qr_data.style,
-        logo_path=qr_data.logo_path,
-        file_path_png=file_paths["png"],
-        file_path_svg=file_paths["svg"],
-        file_path_pdf=file_paths["pdf"]
-    )
+    await db.commit()
+    await db.refresh(new_qr)
     
-    db.add(new_qr)
-    db.commit()
-    db.refresh(new_qr)
+    # Generate QR code images after the response (downloads render on demand
+    # if they are not ready yet)
+    background_tasks.add_task(generate_qr_files, new_qr)
     
     # Check if user is reaching FREE limit and send warning email
     if current_user.subscription_plan == "free":
-        qr_count = db.query(QRCode).filter(QRCode.user_id == current_user.id).count()
         if qr_count >= settings.PLAN_FREE_QR_LIMIT - 1:  # Send warning at limit-1
             from app.services.email import email_service
-            await email_service.send_qr_limit_warning(
+            background_tasks.add_task(
+                email_service.send_qr_limit_warning,
                 to_email=current_user.email,
                 user_name=current_user.full_name or current_user.email,
                 current=qr_count,
@@ -133,25 +215,33 @@ async def create_qr_code(
 
 @router.get("/my-qr-codes", response_model=List[QRCodeResponse])
 async def get_my_qr_codes(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=100),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get all QR codes for current user"""
-    qr_codes = db.query(QRCode).filter(QRCode.user_id == current_user.id).all()
-    return qr_codes
+    """Get QR codes for current user (newest first, paginated)"""
+    rows = (await db.execute(
+        select(*_LIST_COLUMNS)
+        .where(QRCode.user_id == current_user.id)
+        .order_by(QRCode.created_at.desc())
+        .offset(skip)
+        .limit(limit)
+    )).mappings()
+    return [{**row, "scan_url": _SCAN_URL_TEMPLATE.format(row["short_code"])} for row in rows]
 
 
 @router.get("/{qr_id}", response_model=QRCodeResponse)
 async def get_qr_code(
     qr_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get specific QR code"""
-    qr_code = db.query(QRCode).filter(
+    qr_code = await db.scalar(select(QRCode).where(
         QRCode.id == qr_id,
         QRCode.user_id == current_user.id
-    ).first()
+    ))
     
     if not qr_code:
         raise HTTPException(status_code=404, detail="QR code not found")
@@ -164,30 +254,32 @@ async def update_qr_code(
     qr_id: int,
     qr_update: QRCodeUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Update QR code"""
-    qr_code = db.query(QRCode).filter(
-        QRCode.id == qr_id,
-        QRCode.user_id == current_user.id
-    ).first()
+    """Update QR code with a single UPDATE ... RETURNING"""
+    patch = qr_update.model_dump(exclude_unset=True, exclude_none=True, mode="json")
+    
+    owned = (QRCode.id == qr_id, QRCode.user_id == current_user.id)
+    if patch:
+        stmt = update(QRCode).where(*owned).values(**patch).returning(QRCode)
+        # Only dynamic QR codes can change URL
+        if "destination_url" in patch:
+            stmt = stmt.where(QRCode.is_dynamic == True)
+        qr_code = await db.scalar(stmt)
+    else:
+        qr_code = await db.scalar(select(QRCode).where(*owned))
     
     if not qr_code:
+        # Tell a missing QR code apart from a URL change on a static one
+        if await db.scalar(select(QRCode.id).where(*owned)):
+            raise HTTPException(
+                status_code=403,
+                detail="Cannot change URL of static QR code. Upgrade to dynamic QR."
+            )
         raise HTTPException(status_code=404, detail="QR code not found")
     
-    # Check if dynamic (can update URL)
-    if qr_update.destination_url and not qr_code.is_dynamic:
-        raise HTTPException(
-            status_code=403,
-            detail="Cannot change URL of static QR code. Upgrade to dynamic QR."
-        )
-    
-    # Update fields
-    for field, value in qr_update.dict(exclude_unset=True).items():
-        setattr(qr_code, field, value)
-    
-    db.commit()
-    db.refresh(qr_code)
+    await db.commit()
+    invalidate_scan_target(qr_code.short_code)
     
     return qr_code
 
@@ -196,35 +288,50 @@ async def update_qr_code(
 async def delete_qr_code(
     qr_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Delete QR code"""
-    qr_code = db.query(QRCode).filter(
+    qr_code = await db.scalar(select(QRCode).where(
         QRCode.id == qr_id,
         QRCode.user_id == current_user.id
-    ).first()
+    ))
     
     if not qr_code:
         raise HTTPException(status_code=404, detail="QR code not found")
     
-    db.delete(qr_code)
-    db.commit()
+    await db.delete(qr_code)
+    await db.execute(
+        update(User)
+        .where(User.id == current_user.id, User.qr_code_count > 0)
+        .values(qr_code_count=User.qr_code_count - 1)
+        .execution_options(synchronize_session="fetch")
+    )
+    await db.commit()
+    invalidate_scan_target(qr_code.short_code)
     
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
+def _attachment_disposition(filename: str) -> str:
+    """Content-Disposition header value, RFC 5987-encoded for non-ASCII names"""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
 @router.get("/{qr_id}/download/{format}")
 async def download_qr_code(
     qr_id: int,
     format: str,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Download QR code in specified format (png, svg, pdf)"""
-    qr_code = db.query(QRCode).filter(
+    qr_code = await db.scalar(select(QRCode).where(
         QRCode.id == qr_id,
         QRCode.user_id == current_user.id
-    ).first()
+    ))
     
     if not qr_code:
         raise HTTPException(status_code=404, detail="QR code not found")
@@ -245,9 +352,24 @@ async def download_qr_code(
     else:
         raise HTTPException(status_code=400, detail="Invalid format. Use: png, svg, pdf")
     
+    if not file_path:
+        # Background render failed or hasn't finished: render now
+        file_paths = await generate_qr_files(qr_code)
+        file_path = file_paths and file_paths[format]
+    
     if not file_path:
         raise HTTPException(status_code=404, detail=f"Format {format} not available")
     
+    # Let Nginx send the file (zero-copy) when an internal location is configured
+    if settings.QR_ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": settings.QR_ACCEL_REDIRECT_PREFIX + os.path.basename(file_path),
+                "Content-Disposition": _attachment_disposition(f"{qr_code.title}.{format}")
+            }
+        )
+    
     return FileResponse(
         file_path,
         media_type=media_type,
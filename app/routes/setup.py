@@ -2,7 +2,8 @@
 Setup routes for initial platform configuration
 """
 from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
 from app.models.user import User, UserRole
 from app.config import settings
@@ -14,7 +15,7 @@ router = APIRouter(tags=["setup"])
 async def initialize_first_admin(
     email: str,
     secret_key: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Initialize the first admin user
@@ -28,7 +29,7 @@ async def initialize_first_admin(
         raise HTTPException(status_code=403, detail="Invalid secret key")
     
     # Check if an admin already exists
-    existing_admin = db.query(User).filter(User.role == UserRole.ADMIN).first()
+    existing_admin = await db.scalar(select(User).where(User.role == UserRole.ADMIN).limit(1))
     if existing_admin:
         raise HTTPException(
             status_code=400,
@@ -36,14 +37,14 @@ async def initialize_first_admin(
         )
     
     # Find user by email
-    user = db.query(User).filter(User.email == email).first()
+    user = await db.scalar(select(User).where(User.email == email))
     if not user:
         raise HTTPException(status_code=404, detail=f"User with email '{email}' not found")
     
     # Promote to admin
     user.role = UserRole.ADMIN
     user.is_verified = True
-    db.commit()
+    await db.commit()
     
     return {
         "success": True,
@@ -58,11 +59,11 @@ async def initialize_first_admin(
 
 
 @router.get("/setup/check-admin")
-async def check_admin_exists(db: Session = Depends(get_db)):
+async def check_admin_exists(db: AsyncSession = Depends(get_db)):
     """
     Check if an admin user exists in the system
     """
-    admin = db.query(User).filter(User.role == UserRole.ADMIN).first()
+    admin = await db.scalar(select(User).where(User.role == UserRole.ADMIN).limit(1))
     return {
         "admin_exists": admin is not None,
         "admin_email": admin.email if admin else None
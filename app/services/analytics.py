@@ -0,0 +1,206 @@
+"""
+Analytics Service - Scan recording
+"""
+import asyncio
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from sqlalchemy import insert, update, case
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import settings
+from app.database import AsyncSessionLocal, async_engine
+from app.models import QRCode, QRScan, QRCountryCount, QRDeviceCount
+from app.models.qrcode import scan_month_key
+import user_agents
+
+
+class DeviceInfo(NamedTuple):
+    """Device fields extracted from a User-Agent header"""
+    device_type: str
+    os: Optional[str]
+    browser: Optional[str]
+
+
+# Real User-Agents fit comfortably; longer (client-controlled) headers are cut
+# before they become cache keys
+USER_AGENT_MAX_LENGTH = 512
+
+
+def parse_user_agent(user_agent_string: str) -> DeviceInfo:
+    """
+    Parse a User-Agent into device type, OS and browser
+    
+    UA strings are heavily repeated, so results are memoized to skip the
+    regex walk on most scans.
+    """
+    return _parse_user_agent(user_agent_string[:USER_AGENT_MAX_LENGTH])
+
+
+@lru_cache(maxsize=4096)
+def _parse_user_agent(user_agent_string: str) -> DeviceInfo:
+    """Memoized parse of an already truncated User-Agent"""
+    ua = user_agents.parse(user_agent_string)
+    
+    if ua.is_mobile:
+        device_type = "mobile"
+    elif ua.is_tablet:
+        device_type = "tablet"
+    elif ua.is_pc:
+        device_type = "desktop"
+    else:
+        device_type = "other"
+    
+    return DeviceInfo(
+        device_type=device_type,
+        os=ua.os.family or None,
+        browser=ua.browser.family or None
+    )
+
+
+async def bulk_record_scans(db: AsyncSession, rows: List[Dict]) -> None:
+    """
+    Insert many scan rows in one executemany call
+    
+    Rows are plain dicts of QRScan column values; the engine batches them
+    into multi-row INSERT ... VALUES statements (insertmanyvalues).
+    Caller is responsible for committing.
+    """
+    if not rows:
+        return
+    await db.execute(insert(QRScan), rows)
+
+
+def _increment_counter(dialect_name: str, model, qr_code_id: int, key_column: str, key_value: str):
+    """Build an INSERT ... ON CONFLICT DO UPDATE that bumps one rollup counter"""
+    dialect_insert = postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    key = getattr(model, key_column)
+    
+    stmt = dialect_insert(model).values(qr_code_id=qr_code_id, scans=1, **{key_column: key_value})
+    return stmt.on_conflict_do_update(
+        index_elements=[model.qr_code_id, key],
+        set_={"scans": model.scans + 1}
+    )
+
+
+def scan_rollup_statements(
+    dialect_name: str,
+    qr_code_id: int,
+    country: Optional[str],
+    device_type: Optional[str]
+) -> list:
+    """
+    Upsert statements keeping the country/device rollups in step with a new scan
+    
+    Execute them in the same transaction as the QRScan insert.
+    """
+    statements = []
+    if country:
+        statements.append(_increment_counter(dialect_name, QRCountryCount, qr_code_id, "country", country))
+    if device_type:
+        statements.append(_increment_counter(dialect_name, QRDeviceCount, qr_code_id, "device_type", device_type))
+    return statements
+
+
+def scan_counter_update(qr_code_id: int, scanned_at: datetime, count: int = 1):
+    """Atomic UPDATE adding count scans to a QR's counters, resetting the monthly one on month change"""
+    month_key = scan_month_key(scanned_at)
+    return (
+        update(QRCode)
+        .where(QRCode.id == qr_code_id)
+        .values(
+            total_scans=QRCode.total_scans + count,
+            scans_current_month=case(
+                (QRCode.scans_month_key == month_key, QRCode.scans_current_month + count),
+                else_=count
+            ),
+            scans_month_key=month_key,
+            last_scanned_at=scanned_at
+        )
+    )
+
+
+async def record_scan(
+    qr_code_id: int,
+    ip_address: Optional[str],
+    user_agent: str,
+    device_type: str,
+    os: Optional[str],
+    browser: Optional[str],
+    referrer: Optional[str],
+    scanned_at: datetime,
+    country: Optional[str] = None
+) -> None:
+    """
+    Persist one scan with its rollups and counters
+    
+    Runs as a background task after the redirect has been sent, so it
+    opens its own session instead of using the request's.
+    """
+    async with AsyncSessionLocal() as db:
+        await db.execute(insert(QRScan).values(
+            qr_code_id=qr_code_id,
+            scanned_at=scanned_at,
+            ip_address=ip_address,
+            user_agent=user_agent,
+            device_type=device_type,
+            os=os,
+            browser=browser,
+            referrer=referrer,
+            country=country
+        ))
+        
+        for stmt in scan_rollup_statements(async_engine.dialect.name, qr_code_id, country, device_type):
+            await db.execute(stmt)
+        
+        if settings.SCAN_COUNTER_FLUSH_INTERVAL > 0:
+            scan_counters.add(qr_code_id, scanned_at)
+        else:
+            await db.execute(scan_counter_update(qr_code_id, scanned_at))
+        await db.commit()
+
+
+class ScanCounterBuffer:
+    """
+    Coalesces scan counter increments in memory
+    
+    Each flush issues one UPDATE per QR code (total_scans + n) instead of one
+    per scan, which keeps hot rows of viral QR codes from contending.
+    """
+    
+    def __init__(self):
+        self._pending: Dict[int, Tuple[int, datetime]] = {}
+    
+    def add(self, qr_code_id: int, scanned_at: datetime, count: int = 1) -> None:
+        """Queue count scans for a QR code"""
+        pending_count, last_scanned_at = self._pending.get(qr_code_id, (0, scanned_at))
+        self._pending[qr_code_id] = (pending_count + count, max(last_scanned_at, scanned_at))
+    
+    async def flush(self) -> None:
+        """Write all queued increments; requeue them if the write fails"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        
+        try:
+            async with AsyncSessionLocal() as db:
+                for qr_code_id, (count, last_scanned_at) in pending.items():
+                    await db.execute(scan_counter_update(qr_code_id, last_scanned_at, count))
+                await db.commit()
+        except Exception:
+            for qr_code_id, (count, last_scanned_at) in pending.items():
+                self.add(qr_code_id, last_scanned_at, count)
+            raise
+    
+    async def run(self, interval: float) -> None:
+        """Flush periodically until cancelled"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[SCAN COUNTER ERROR] {str(e)}")
+
+
+# Global instance
+scan_counters = ScanCounterBuffer()
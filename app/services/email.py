@@ -1,54 +1,19 @@
 """
 Email Service with SendGrid - Complete Implementation
 """
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
-from typing import Optional
-from jinja2 import Template
+import httpx
+import textwrap
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+from jinja2 import Environment
+from markupsafe import escape
 from datetime import datetime
 from app.config import settings
 
 
-class EmailService:
-    """Service for sending emails via SendGrid"""
-    
-    def __init__(self):
-        self.client = SendGridAPIClient(settings.SENDGRID_API_KEY) if settings.SENDGRID_API_KEY else None
-        self.from_email = Email(settings.FROM_EMAIL, settings.FROM_NAME)
-    
-    async def send_email(
-        self,
-        to_email: str,
-        subject: str,
-        html_content: str,
-        text_content: Optional[str] = None
-    ) -> bool:
-        """Send email"""
-        if not self.client:
-            print(f"[EMAIL SIMULATION] To: {to_email} | Subject: {subject}")
-            return True
-        
-        try:
-            message = Mail(
-                from_email=self.from_email,
-                to_emails=To(to_email),
-                subject=subject,
-                html_content=Content("text/html", html_content)
-            )
-            
-            if text_content:
-                message.add_content(Content("text/plain", text_content))
-            
-            response = self.client.send(message)
-            return response.status_code == 202
-        
-        except Exception as e:
-            print(f"[EMAIL ERROR] {str(e)}")
-            return False
-    
-    async def send_welcome_email(self, to_email: str, user_name: str) -> bool:
-        """Send welcome email to new user"""
-        template = """
+# Email templates
+WELCOME_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #4F46E5;">Benvenuto su QR Code Pro!</h1>
@@ -75,21 +40,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(
-            user_name=user_name,
-            frontend_url=settings.FRONTEND_URL
-        )
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject="Benvenuto su QR Code Pro! 🎉",
-            html_content=html
-        )
-    
-    async def send_upgrade_promotion(self, to_email: str, user_name: str, discount_code: str = "SAVE20") -> bool:
-        """Send upgrade promotion email"""
-        template = """
+
+UPGRADE_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #4F46E5;">Sblocca tutto il potenziale! 🚀</h1>
@@ -122,22 +74,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(
-            user_name=user_name,
-            app_url=settings.APP_URL,
-            discount_code=discount_code
-        )
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject=f"🎁 20% di sconto su QR Code PRO!",
-            html_content=html
-        )
-    
-    async def send_subscription_confirmation(self, to_email: str, plan: str) -> bool:
-        """Send subscription confirmation email"""
-        template = """
+
+SUBSCRIPTION_CONFIRMATION_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #10B981;">Abbonamento Attivato! ✅</h1>
@@ -153,23 +91,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(
-            plan=plan.upper(),
-            app_url=settings.APP_URL
-        )
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject="Abbonamento attivato!",
-            html_content=html
-        )
-    
-    async def send_verification_email(self, to_email: str, user_name: str, verification_token: str) -> bool:
-        """Send email verification"""
-        verification_url = f"{settings.FRONTEND_URL}/verify?token={verification_token}"
-        
-        template = """
+
+VERIFICATION_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #4F46E5;">Verifica il tuo account</h1>
@@ -194,23 +117,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(
-            user_name=user_name,
-            verification_url=verification_url
-        )
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject="✉️ Verifica il tuo account QR Code Pro",
-            html_content=html
-        )
-    
-    async def send_password_reset(self, to_email: str, reset_token: str) -> bool:
-        """Send password reset email"""
-        reset_url = f"{settings.FRONTEND_URL}/reset-password?token={reset_token}"
-        
-        template = """
+
+PASSWORD_RESET_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #EF4444;">Reset Password</h1>
@@ -234,18 +142,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(reset_url=reset_url)
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject="🔑 Reset della tua password",
-            html_content=html
-        )
-    
-    async def send_abandoned_cart_email(self, to_email: str, user_name: str, plan: str) -> bool:
-        """Send abandoned cart reminder"""
-        template = """
+
+ABANDONED_CART_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #F59E0B;">Hai dimenticato qualcosa? 🛒</h1>
@@ -273,22 +171,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(
-            user_name=user_name,
-            plan=plan.upper(),
-            app_url=settings.FRONTEND_URL
-        )
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject=f"🎁 15% di sconto sul piano {plan.upper()}!",
-            html_content=html
-        )
-    
-    async def send_qr_limit_warning(self, to_email: str, user_name: str, current: int, limit: int) -> bool:
-        """Send QR limit warning for free users"""
-        template = """
+
+QR_LIMIT_WARNING_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #F59E0B;">⚠️ Stai raggiungendo il limite!</h1>
@@ -314,23 +198,8 @@ class EmailService:
         </body>
         </html>
         """
-        
-        html = Template(template).render(
-            user_name=user_name,
-            current=current,
-            limit=limit,
-            app_url=settings.FRONTEND_URL
-        )
-        
-        return await self.send_email(
-            to_email=to_email,
-            subject="⚠️ Stai raggiungendo il limite di QR code",
-            html_content=html
-        )
-    
-    async def send_monthly_report(self, to_email: str, user_name: str, stats: dict) -> bool:
-        """Send monthly analytics report"""
-        template = """
+
+MONTHLY_REPORT_HTML = """
         <html>
         <body style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
             <h1 style="color: #4F46E5;">📊 Report Mensile</h1>
@@ -375,18 +244,288 @@ class EmailService:
         </body>
         </html>
         """
+
+
+# Compiled once at import; autoescape guards user-supplied values (names, titles)
+_env = Environment(autoescape=True, trim_blocks=True, lstrip_blocks=True)
+_TEMPLATES = {
+    "welcome": _env.from_string(textwrap.dedent(WELCOME_HTML).strip()),
+    "upgrade": _env.from_string(textwrap.dedent(UPGRADE_HTML).strip()),
+    "subscription_confirmation": _env.from_string(textwrap.dedent(SUBSCRIPTION_CONFIRMATION_HTML).strip()),
+    "verification": _env.from_string(textwrap.dedent(VERIFICATION_HTML).strip()),
+    "password_reset": _env.from_string(textwrap.dedent(PASSWORD_RESET_HTML).strip()),
+    "abandoned_cart": _env.from_string(textwrap.dedent(ABANDONED_CART_HTML).strip()),
+    "qr_limit_warning": _env.from_string(textwrap.dedent(QR_LIMIT_WARNING_HTML).strip()),
+    "monthly_report": _env.from_string(textwrap.dedent(MONTHLY_REPORT_HTML).strip()),
+}
+
+# Placeholder rendered in place of the user name so campaign shells can be reused
+_USER_NAME_SLOT = "\x00user_name\x00"
+
+
+@lru_cache(maxsize=256)
+def _template_shell(template_name: str, **params) -> Tuple[str, ...]:
+    """Render a template once per non-personal parameter set, split at the user name"""
+    html = _TEMPLATES[template_name].render(user_name=_USER_NAME_SLOT, **params)
+    return tuple(html.split(_USER_NAME_SLOT))
+
+
+def _render_personalized(template_name: str, user_name: str, **params) -> str:
+    """Render a campaign template, interpolating only the (escaped) user name per send"""
+    return str(escape(user_name)).join(_template_shell(template_name, **params))
+
+
+# SendGrid accepts at most 1000 personalizations per /v3/mail/send request
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+
+# SendGrid substitution tags filled in per recipient of a batched monthly report
+_MONTHLY_REPORT_TAGS = {
+    "user_name": "-user_name-",
+    "total_qr": "-total_qr-",
+    "total_scans": "-total_scans-",
+    "month_scans": "-month_scans-",
+}
+
+
+@lru_cache(maxsize=1)
+def _monthly_report_batch_html() -> str:
+    """Monthly report body with substitution tags in place of per-user values"""
+    return _TEMPLATES["monthly_report"].render(
+        user_name=_MONTHLY_REPORT_TAGS["user_name"],
+        stats=_MONTHLY_REPORT_TAGS,
+        app_url=settings.FRONTEND_URL
+    )
+
+
+def _batches(items: Iterable, size: int) -> Iterator[list]:
+    """Split items into lists of at most size elements"""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class EmailService:
+    """Service for sending emails via SendGrid"""
+    
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None  # Opened by startup(); None simulates sends
+        self.from_email = {"email": settings.FROM_EMAIL, "name": settings.FROM_NAME}
+    
+    async def startup(self) -> None:
+        """Open the pooled SendGrid client, so sends reuse keep-alive TLS connections"""
+        if settings.SENDGRID_API_KEY and not self.client:
+            self.client = httpx.AsyncClient(
+                base_url="https://api.sendgrid.com",
+                headers={"Authorization": f"Bearer {settings.SENDGRID_API_KEY}"},
+                timeout=10,
+                limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60)
+            )
+    
+    async def shutdown(self) -> None:
+        """Close pooled SendGrid connections"""
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+    
+    async def _post_mail(self, payload: dict) -> bool:
+        """POST a /v3/mail/send payload, True if SendGrid accepted it"""
+        try:
+            response = await self.client.post("/v3/mail/send", json=payload)
+            return response.status_code == 202
+        
+        except Exception as e:
+            print(f"[EMAIL ERROR] {str(e)}")
+            return False
+    
+    async def send_email(
+        self,
+        to_email: str,
+        subject: str,
+        html_content: str,
+        text_content: Optional[str] = None
+    ) -> bool:
+        """Send email"""
+        if not self.client:
+            print(f"[EMAIL SIMULATION] To: {to_email} | Subject: {subject}")
+            return True
+        
+        # SendGrid requires text/plain to come before text/html
+        content = [{"type": "text/html", "value": html_content}]
+        if text_content:
+            content.insert(0, {"type": "text/plain", "value": text_content})
+        
+        return await self._post_mail({
+            "personalizations": [{"to": [{"email": to_email}]}],
+            "from": self.from_email,
+            "subject": subject,
+            "content": content
+        })
+    
+    async def send_template(
+        self,
+        to_email: str,
+        subject: str,
+        template_name: str,
+        template_data: dict,
+        personalized: bool = False
+    ) -> bool:
+        """
+        Send a named template
+        
+        Uses the SendGrid Dynamic Template configured in SENDGRID_TEMPLATE_IDS
+        (only template_data goes over the wire); otherwise renders the local HTML.
+        personalized templates reuse a cached shell and insert only user_name.
+        """
+        template_id = settings.SENDGRID_TEMPLATE_IDS.get(template_name)
+        if template_id and self.client:
+            return await self._post_mail({
+                "personalizations": [{
+                    "to": [{"email": to_email}],
+                    "dynamic_template_data": {"subject": subject, **template_data}
+                }],
+                "from": self.from_email,
+                "template_id": template_id
+            })
+        
+        if personalized:
+            params = dict(template_data)
+            html = _render_personalized(template_name, params.pop("user_name"), **params)
+        else:
+            html = _TEMPLATES[template_name].render(**template_data)
+        
+        return await self.send_email(to_email=to_email, subject=subject, html_content=html)
+    
+    async def send_bulk_email(self, html_content: str, personalizations: List[dict], template_id: Optional[str] = None) -> int:
+        """
+        Send one message to many recipients, batching personalizations per request
+        
+        Each personalization carries its own "to" and "subject", plus either
+        "substitutions" for html_content or "dynamic_template_data" for template_id.
+        
+        Returns:
+            Number of recipients accepted by SendGrid
+        """
+        sent = 0
+        for batch in _batches(personalizations, SENDGRID_MAX_PERSONALIZATIONS):
+            if not self.client:
+                for personalization in batch:
+                    print(f"[EMAIL SIMULATION] To: {personalization['to'][0]['email']} | Subject: {personalization['subject']}")
+                sent += len(batch)
+                continue
+            
+            payload = {"personalizations": batch, "from": self.from_email}
+            if template_id:
+                payload["template_id"] = template_id
+            else:
+                payload["content"] = [{"type": "text/html", "value": html_content}]
+            
+            if await self._post_mail(payload):
+                sent += len(batch)
         
-        html = Template(template).render(
-            user_name=user_name,
-            stats=stats,
-            app_url=settings.FRONTEND_URL
+        return sent
+    
+    async def send_welcome_email(self, to_email: str, user_name: str) -> bool:
+        """Send welcome email to new user"""
+        return await self.send_template(
+            to_email=to_email,
+            subject="Benvenuto su QR Code Pro! 🎉",
+            template_name="welcome",
+            template_data={"user_name": user_name, "frontend_url": settings.FRONTEND_URL}
+        )
+    
+    async def send_upgrade_promotion(self, to_email: str, user_name: str, discount_code: str = "SAVE20") -> bool:
+        """Send upgrade promotion email"""
+        return await self.send_template(
+            to_email=to_email,
+            subject=f"🎁 20% di sconto su QR Code PRO!",
+            template_name="upgrade",
+            template_data={"user_name": user_name, "app_url": settings.APP_URL, "discount_code": discount_code},
+            personalized=True
         )
+    
+    async def send_subscription_confirmation(self, to_email: str, plan: str) -> bool:
+        """Send subscription confirmation email"""
+        return await self.send_template(
+            to_email=to_email,
+            subject="Abbonamento attivato!",
+            template_name="subscription_confirmation",
+            template_data={"plan": plan.upper(), "app_url": settings.APP_URL}
+        )
+    
+    async def send_verification_email(self, to_email: str, user_name: str, verification_token: str) -> bool:
+        """Send email verification"""
+        verification_url = f"{settings.FRONTEND_URL}/verify?token={verification_token}"
         
-        return await self.send_email(
+        return await self.send_template(
+            to_email=to_email,
+            subject="✉️ Verifica il tuo account QR Code Pro",
+            template_name="verification",
+            template_data={"user_name": user_name, "verification_url": verification_url}
+        )
+    
+    async def send_password_reset(self, to_email: str, reset_token: str) -> bool:
+        """Send password reset email"""
+        reset_url = f"{settings.FRONTEND_URL}/reset-password?token={reset_token}"
+        
+        return await self.send_template(
+            to_email=to_email,
+            subject="🔑 Reset della tua password",
+            template_name="password_reset",
+            template_data={"reset_url": reset_url}
+        )
+    
+    async def send_abandoned_cart_email(self, to_email: str, user_name: str, plan: str) -> bool:
+        """Send abandoned cart reminder"""
+        return await self.send_template(
+            to_email=to_email,
+            subject=f"🎁 15% di sconto sul piano {plan.upper()}!",
+            template_name="abandoned_cart",
+            template_data={"user_name": user_name, "plan": plan.upper(), "app_url": settings.FRONTEND_URL},
+            personalized=True
+        )
+    
+    async def send_qr_limit_warning(self, to_email: str, user_name: str, current: int, limit: int) -> bool:
+        """Send QR limit warning for free users"""
+        return await self.send_template(
+            to_email=to_email,
+            subject="⚠️ Stai raggiungendo il limite di QR code",
+            template_name="qr_limit_warning",
+            template_data={"user_name": user_name, "current": current, "limit": limit, "app_url": settings.FRONTEND_URL},
+            personalized=True
+        )
+    
+    async def send_monthly_report(self, to_email: str, user_name: str, stats: dict) -> bool:
+        """Send monthly analytics report"""
+        return await self.send_template(
             to_email=to_email,
             subject=f"📊 Report mensile - {stats['month_scans']} scansioni",
-            html_content=html
+            template_name="monthly_report",
+            template_data={"user_name": user_name, "stats": stats, "app_url": settings.FRONTEND_URL}
         )
+    
+    async def send_monthly_reports(self, reports: List[Tuple[str, str, dict]]) -> int:
+        """Send monthly reports for (email, user_name, stats) tuples in batched requests"""
+        template_id = settings.SENDGRID_TEMPLATE_IDS.get("monthly_report")
+        
+        personalizations = []
+        for to_email, user_name, stats in reports:
+            subject = f"📊 Report mensile - {stats['month_scans']} scansioni"
+            personalization = {"to": [{"email": to_email}], "subject": subject}
+            if template_id:
+                personalization["dynamic_template_data"] = {
+                    "subject": subject,
+                    "user_name": user_name,
+                    "stats": stats,
+                    "app_url": settings.FRONTEND_URL
+                }
+            else:
+                personalization["substitutions"] = {
+                    _MONTHLY_REPORT_TAGS["user_name"]: str(escape(user_name)),
+                    **{_MONTHLY_REPORT_TAGS[key]: str(stats[key]) for key in ("total_qr", "total_scans", "month_scans")}
+                }
+            personalizations.append(personalization)
+        
+        return await self.send_bulk_email(_monthly_report_batch_html(), personalizations, template_id=template_id)
 
 
 # Global instance
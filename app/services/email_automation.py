@@ -3,99 +3,99 @@ Background tasks for email automation
 """
 import asyncio
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-from app.database import SessionLocal
-from app.models.user import User
+from sqlalchemy import select, func
+from app.database import AsyncSessionLocal, async_engine
+from app.models import User, QRCode, QRScan, SubscriptionPlan
 from app.services.email import email_service
+from app.config import settings
+
+
+async def _send_concurrently(items, send_one) -> None:
+    """Run send_one for every item, at most EMAIL_CAMPAIGN_CONCURRENCY at a time"""
+    semaphore = asyncio.Semaphore(settings.EMAIL_CAMPAIGN_CONCURRENCY)
+    
+    async def _bounded(item):
+        async with semaphore:
+            await send_one(item)
+    
+    await asyncio.gather(*(_bounded(item) for item in items))
 
 
 async def send_upgrade_promotions():
     """Send upgrade promotions to FREE users who haven't upgraded"""
-    db = SessionLocal()
-    try:
-        # Get FREE users who registered 3+ days ago
-        three_days_ago = datetime.utcnow() - timedelta(days=3)
-        free_users = db.query(User).filter(
-            User.subscription_plan == "free",
-            User.created_at <= three_days_ago,
-            User.is_verified == True
-        ).all()
-        
-        for user in free_users:
-            # Check if user has created QR codes
-            if user.qr_codes and len(user.qr_codes) > 0:
-                await email_service.send_upgrade_promotion(
-                    to_email=user.email,
-                    user_name=user.full_name or user.email
-                )
-                print(f"[EMAIL] Sent upgrade promo to {user.email}")
-                await asyncio.sleep(2)  # Rate limiting
-                
-    finally:
-        db.close()
+    # FREE users who registered 3+ days ago and have created QR codes
+    three_days_ago = datetime.utcnow() - timedelta(days=3)
+    async with AsyncSessionLocal() as db:
+        recipients = (await db.scalars(
+            select(User)
+            .join(QRCode, QRCode.user_id == User.id)
+            .where(
+                User.subscription_plan == SubscriptionPlan.FREE,
+                User.created_at <= three_days_ago,
+                User.is_verified == True
+            )
+            .group_by(User.id)
+        )).all()
+    
+    async def _send(user):
+        await email_service.send_upgrade_promotion(
+            to_email=user.email,
+            user_name=user.full_name or user.email
+        )
+        print(f"[EMAIL] Sent upgrade promo to {user.email}")
+    
+    await _send_concurrently(recipients, _send)
 
 
 async def send_abandoned_cart_emails():
     """Send emails to users who visited pricing but didn't upgrade"""
     # This would track users who visited /pricing page
     # For now, we'll send to FREE users who have hit their QR limit
-    db = SessionLocal()
-    try:
-        free_users = db.query(User).filter(
-            User.subscription_plan == "free"
-        ).all()
-        
-        for user in free_users:
-            # Check if user has reached QR limit
-            if user.qr_codes and len(user.qr_codes) >= 3:
-                await email_service.send_abandoned_cart_email(
-                    to_email=user.email,
-                    user_name=user.full_name or user.email,
-                    plan="PRO"
-                )
-                print(f"[EMAIL] Sent abandoned cart email to {user.email}")
-                await asyncio.sleep(2)
-                
-    finally:
-        db.close()
+    async with AsyncSessionLocal() as db:
+        recipients = (await db.scalars(
+            select(User)
+            .join(QRCode, QRCode.user_id == User.id)
+            .where(User.subscription_plan == SubscriptionPlan.FREE)
+            .group_by(User.id)
+            .having(func.count(QRCode.id) >= 3)
+        )).all()
+    
+    async def _send(user):
+        await email_service.send_abandoned_cart_email(
+            to_email=user.email,
+            user_name=user.full_name or user.email,
+            plan="PRO"
+        )
+        print(f"[EMAIL] Sent abandoned cart email to {user.email}")
+    
+    await _send_concurrently(recipients, _send)
 
 
 async def send_monthly_reports():
     """Send monthly analytics reports to all users"""
-    db = SessionLocal()
-    try:
-        users = db.query(User).filter(User.is_verified == True).all()
-        
-        for user in users:
-            if not user.qr_codes or len(user.qr_codes) == 0:
-                continue
-                
-            # Calculate stats
-            total_qr = len(user.qr_codes)
-            total_scans = sum(len(qr.scans) for qr in user.qr_codes)
-            
-            # Scans this month
-            month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            month_scans = 0
-            for qr in user.qr_codes:
-                month_scans += len([s for s in qr.scans if s.scanned_at >= month_start])
-            
-            stats = {
-                "total_qr": total_qr,
-                "total_scans": total_scans,
-                "month_scans": month_scans
-            }
-            
-            await email_service.send_monthly_report(
-                to_email=user.email,
-                user_name=user.full_name or user.email,
-                stats=stats
+    # Per-user QR and scan totals in one aggregate query (users without QR codes drop out)
+    month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(
+                User.email,
+                User.full_name,
+                func.count(func.distinct(QRCode.id)),
+                func.count(QRScan.id),
+                func.count(QRScan.id).filter(QRScan.scanned_at >= month_start)
             )
-            print(f"[EMAIL] Sent monthly report to {user.email}")
-            await asyncio.sleep(2)
-            
-    finally:
-        db.close()
+            .join(QRCode, QRCode.user_id == User.id)
+            .outerjoin(QRScan, QRScan.qr_code_id == QRCode.id)
+            .where(User.is_verified == True)
+            .group_by(User.id)
+        )).all()
+    
+    # One SendGrid request per 1000 recipients
+    sent = await email_service.send_monthly_reports([
+        (email, full_name or email, {"total_qr": total_qr, "total_scans": total_scans, "month_scans": month_scans})
+        for email, full_name, total_qr, total_scans, month_scans in rows
+    ])
+    print(f"[EMAIL] Sent {sent} monthly reports")
 
 
 # Scheduler function (to be called by a cron job or task scheduler)
@@ -119,6 +119,16 @@ async def run_monthly_reports():
     print("[MONTHLY REPORTS] Complete!")
 
 
+async def _run_standalone(job):
+    """Run a job outside the app, closing pooled connections afterwards"""
+    await email_service.startup()
+    try:
+        await job()
+    finally:
+        await email_service.shutdown()
+        await async_engine.dispose()
+
+
 if __name__ == "__main__":
     # For testing
-    asyncio.run(run_email_campaigns())
+    asyncio.run(_run_standalone(run_email_campaigns))
@@ -4,12 +4,99 @@ QR Code Generator Service
 import qrcode
 from qrcode.image.styledpil import StyledPilImage
 from qrcode.image.styles.moduledrawers import RoundedModuleDrawer, CircleModuleDrawer, SquareModuleDrawer
-from PIL import Image, ImageDraw
+from PIL import Image, ImageColor, ImageDraw
 import io
+from html import escape
 import os
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from typing import Optional, Tuple
 from app.config import settings
 
+_EC_MAP = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+# Drawer classes rather than instances: drawers keep per-image state
+# (box size, colours) once a StyledPilImage initializes them
+_MODULE_DRAWERS = {
+    "rounded": RoundedModuleDrawer,
+    "dots": CircleModuleDrawer,
+}
+
+_MONO_COLORS = {"#000000": "black", "#FFFFFF": "white"}
+
+# Rendering is CPU-bound, so async callers run it in worker processes
+# (created on first use) to keep it off the event loop and the GIL
+_render_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    """Return the shared render process pool, starting it if needed"""
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(
+            max_workers=settings.QR_RENDER_WORKERS or None,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _render_pool
+
+
+# Per-thread scratch buffer reused by every encode instead of a fresh BytesIO
+_scratch = threading.local()
+
+
+def _encode(img: Image.Image, **save_params) -> bytes:
+    """Encode img into the thread's scratch buffer and return a copy of the bytes"""
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None:
+        buffer = _scratch.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    img.save(buffer, **save_params)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=64)
+def _prepared_logo(logo_path: str, mtime_ns: int, logo_size: int) -> Image.Image:
+    """Load and resize a logo onto its white backing square (treat the result as read-only)"""
+    # Open and resize logo
+    logo = Image.open(logo_path)
+    logo = logo.convert("RGBA")
+    logo = logo.resize((logo_size, logo_size), Image.Resampling.LANCZOS)
+    
+    # Composite the logo onto a small opaque white square; since it fully
+    # covers its region, the QR never needs an alpha channel
+    logo_bg = Image.new('RGB', (logo_size + 20, logo_size + 20), 'white')
+    logo_bg_pos = ((logo_bg.size[0] - logo_size) // 2, (logo_bg.size[1] - logo_size) // 2)
+    logo_bg.paste(logo, logo_bg_pos, logo)
+    return logo_bg
+
+
+def _write_file(path: str, data: bytes) -> None:
+    """Write data to path with raw os calls (no buffered file object)"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def shutdown_render_pool() -> None:
+    """Stop the render worker processes"""
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(cancel_futures=True)
+        _render_pool = None
+
 
 class QRCodeGenerator:
     """Service for generating and customizing QR codes"""
@@ -46,18 +133,10 @@ class QRCodeGenerator:
         Returns:
             Tuple of (png_bytes, svg_bytes, pdf_bytes)
         """
-        # Map error correction
-        ec_map = {
-            "L": qrcode.constants.ERROR_CORRECT_L,
-            "M": qrcode.constants.ERROR_CORRECT_M,
-            "Q": qrcode.constants.ERROR_CORRECT_Q,
-            "H": qrcode.constants.ERROR_CORRECT_H,
-        }
-        
         # Create QR code instance
         qr = qrcode.QRCode(
             version=None,  # Auto-determine
-            error_correction=ec_map.get(error_correction, qrcode.constants.ERROR_CORRECT_M),
+            error_correction=_EC_MAP.get(error_correction, qrcode.constants.ERROR_CORRECT_M),
             box_size=10,
             border=4,
         )
@@ -65,11 +144,18 @@ class QRCodeGenerator:
         qr.add_data(data)
         qr.make(fit=True)
         
+        # Render modules at the final resolution instead of resampling afterwards
+        qr.box_size = max(1, size // (qr.modules_count + 2 * qr.border))
+        
         # Select style
         module_drawer = self._get_module_drawer(style)
+        has_logo = bool(logo_path and os.path.exists(logo_path))
         
         # Generate image
-        if module_drawer:
+        if not module_drawer and not has_logo and size >= qr.modules_count + 2 * qr.border:
+            # Plain square modules (the common case): skip qrcode's per-module drawing
+            img = self._render_square(qr, size, foreground_color, background_color)
+        elif module_drawer:
             img = qr.make_image(
                 image_factory=StyledPilImage,
                 module_drawer=module_drawer,
@@ -77,17 +163,22 @@ class QRCodeGenerator:
                 back_color=background_color
             )
         else:
+            # qrcode renders plain black-on-white as a 1-bit image when given colour names
             img = qr.make_image(
-                fill_color=foreground_color,
-                back_color=background_color
+                fill_color=_MONO_COLORS.get(foreground_color.upper(), foreground_color),
+                back_color=_MONO_COLORS.get(background_color.upper(), background_color)
             )
         
         # Add logo if provided
-        if logo_path and os.path.exists(logo_path):
+        if has_logo:
             img = self._add_logo(img, logo_path, logo_size_ratio)
         
-        # Resize to desired size
-        img = img.resize((size, size), Image.Resampling.LANCZOS)
+        # Fit to the exact requested size without blurring module edges
+        img = self._fit_to_size(img, size, background_color)
+        
+        # One pixel buffer feeds both raster encoders (default colours stay 1-bit or 2-colour)
+        if img.mode not in ("1", "P", "RGB"):
+            img = img.convert("RGB")
         
         # Convert to bytes
         png_bytes = self._to_png(img)
@@ -97,56 +188,109 @@ class QRCodeGenerator:
         return png_bytes, svg_bytes, pdf_bytes
     
     def _get_module_drawer(self, style: str):
-        """Get module drawer based on style"""
-        if style == "rounded":
-            return RoundedModuleDrawer()
-        elif style == "dots":
-            return CircleModuleDrawer()
-        else:  # square
-            return None  # Use default
+        """Get module drawer based on style (None for square, the default)"""
+        drawer_class = _MODULE_DRAWERS.get(style)
+        return drawer_class() if drawer_class else None
     
-    def _add_logo(self, qr_img: Image.Image, logo_path: str, size_ratio: float) -> Image.Image:
-        """Add logo to center of QR code"""
-        qr_img = qr_img.convert("RGBA")
+    def _render_square(self, qr: qrcode.QRCode, size: int, fill_color: str, back_color: str) -> Image.Image:
+        """Build a size x size 2-colour palette image straight from the module matrix"""
+        matrix = qr.get_matrix()  # Includes the quiet-zone border
+        box = qr.box_size
+        width = len(matrix) * box
+        before = (size - width) // 2
+        after = size - width - before
         
-        # Open and resize logo
-        logo = Image.open(logo_path)
-        logo = logo.convert("RGBA")
+        # One byte per pixel: palette index 1 for dark modules, 0 for background
+        dark, light = b"\x01" * box, b"\x00" * box
+        left, right = b"\x00" * before, b"\x00" * after
+        pixels = b"".join((
+            b"\x00" * (size * before),
+            *((left + b"".join(dark if cell else light for cell in row) + right) * box for row in matrix),
+            b"\x00" * (size * after),
+        ))
         
+        img = Image.frombytes("P", (size, size), pixels)
+        img.putpalette(ImageColor.getrgb(back_color)[:3] + ImageColor.getrgb(fill_color)[:3])
+        return img
+    
+    def _add_logo(self, qr_img: Image.Image, logo_path: str, size_ratio: float) -> Image.Image:
+        """Add logo to center of QR code"""
         # Calculate logo size
         qr_width, qr_height = qr_img.size
         logo_size = int(min(qr_width, qr_height) * size_ratio)
-        logo = logo.resize((logo_size, logo_size), Image.Resampling.LANCZOS)
         
-        # Create white background for logo
-        logo_bg = Image.new('RGBA', (logo_size + 20, logo_size + 20), 'white')
-        logo_bg_pos = ((logo_bg.size[0] - logo_size) // 2, (logo_bg.size[1] - logo_size) // 2)
-        logo_bg.paste(logo, logo_bg_pos, logo)
+        # The mtime in the key makes a replaced logo file miss the cache
+        logo_bg = _prepared_logo(logo_path, os.stat(logo_path).st_mtime_ns, logo_size)
         
-        # Paste logo in center
+        # Paste logo in center (1-bit QR codes need colour to hold the logo)
+        if qr_img.mode != "RGB":
+            qr_img = qr_img.convert("RGB")
         logo_pos = ((qr_width - logo_bg.size[0]) // 2, (qr_height - logo_bg.size[1]) // 2)
-        qr_img.paste(logo_bg, logo_pos, logo_bg)
+        qr_img.paste(logo_bg, logo_pos)
         
         return qr_img
     
+    def _fit_to_size(self, img: Image.Image, size: int, back_color: str) -> Image.Image:
+        """Pad (or nearest-neighbour shrink) the rendered QR to size x size pixels"""
+        if img.size[0] > size:
+            return img.resize((size, size), Image.Resampling.NEAREST)
+        if img.size[0] == size:
+            return img
+        canvas = Image.new(img.mode, (size, size), back_color)
+        offset = (size - img.size[0]) // 2
+        canvas.paste(img, (offset, offset))
+        return canvas
+    
     def _to_png(self, img: Image.Image) -> bytes:
         """Convert PIL Image to PNG bytes"""
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        return buffer.getvalue()
+        # Two-tone images compress well even at zlib level 1, which is several
+        # times cheaper than Pillow's default level 6
+        if img.mode == "P":
+            # 2-colour palette images pack 8 pixels per byte
+            return _encode(img, format="PNG", compress_level=1, bits=1)
+        return _encode(img, format="PNG", compress_level=1)
     
     def _to_svg(self, qr: qrcode.QRCode, fill_color: str, back_color: str) -> bytes:
-        """Generate SVG representation"""
-        # For now, return empty bytes - full SVG implementation would be here
-        # This requires additional library like qrcode[svg]
-        return b""
+        """Generate SVG representation straight from the module matrix"""
+        matrix = qr.get_matrix()  # Includes the quiet-zone border
+        n = len(matrix)
+        
+        out = io.StringIO()
+        out.write(
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {n} {n}" shape-rendering="crispEdges">'
+            f'<rect width="{n}" height="{n}" fill="{escape(back_color)}"/>'
+            f'<g fill="{escape(fill_color)}">'
+        )
+        # One rect per horizontal run of dark modules
+        for y, row in enumerate(matrix):
+            x = 0
+            while x < n:
+                if row[x]:
+                    start = x
+                    while x < n and row[x]:
+                        x += 1
+                    out.write(f'<rect x="{start}" y="{y}" width="{x - start}" height="1"/>')
+                else:
+                    x += 1
+        out.write("</g></svg>")
+        return out.getvalue().encode()
     
     def _to_pdf(self, img: Image.Image) -> bytes:
         """Convert to PDF bytes"""
-        buffer = io.BytesIO()
-        img_rgb = img.convert("RGB")
-        img_rgb.save(buffer, format="PDF")
-        return buffer.getvalue()
+        if img.mode == "P":
+            # Pillow hex-encodes palette images in PDFs; black-on-white goes 1-bit
+            # (CCITT compressed), other colours RGB
+            img = img.convert("1" if img.getpalette()[:6] == [255, 255, 255, 0, 0, 0] else "RGB")
+        return _encode(img, format="PDF")
+    
+    def _file_paths(self, short_code: str, svg_data: bytes) -> dict:
+        """Storage paths for a QR code's files (no SVG path when there is no SVG)"""
+        base_path = os.path.join(self.storage_path, short_code)
+        return {
+            "png": f"{base_path}.png",
+            "svg": f"{base_path}.svg" if svg_data else None,
+            "pdf": f"{base_path}.pdf",
+        }
     
     def save_files(self, short_code: str, png_data: bytes, svg_data: bytes, pdf_data: bytes) -> dict:
         """
@@ -155,26 +299,41 @@ class QRCodeGenerator:
         Returns:
             Dict with file paths
         """
-        base_path = os.path.join(self.storage_path, short_code)
-        
-        paths = {
-            "png": f"{base_path}.png",
-            "svg": f"{base_path}.svg" if svg_data else None,
-            "pdf": f"{base_path}.pdf",
-        }
+        paths = self._file_paths(short_code, svg_data)
         
         # Save files
-        with open(paths["png"], "wb") as f:
-            f.write(png_data)
+        for fmt, data in (("png", png_data), ("svg", svg_data), ("pdf", pdf_data)):
+            if data:
+                _write_file(paths[fmt], data)
         
-        if svg_data:
-            with open(paths["svg"], "wb") as f:
-                f.write(svg_data)
+        return paths
+    
+    async def save_files_async(self, short_code: str, png_data: bytes, svg_data: bytes, pdf_data: bytes) -> dict:
+        """Async save_files: write the files concurrently in worker threads"""
+        paths = self._file_paths(short_code, svg_data)
         
-        with open(paths["pdf"], "wb") as f:
-            f.write(pdf_data)
+        await asyncio.gather(*(
+            asyncio.to_thread(_write_file, paths[fmt], data)
+            for fmt, data in (("png", png_data), ("svg", svg_data), ("pdf", pdf_data))
+            if data
+        ))
         
         return paths
+    
+    def generate_and_save(self, short_code: str, data: str, **options) -> dict:
+        """Generate QR code images and save them to storage, returning file paths"""
+        png_bytes, svg_bytes, pdf_bytes = self.generate(data, **options)
+        return self.save_files(short_code, png_bytes, svg_bytes, pdf_bytes)
+    
+    async def generate_async(self, data: str, **options) -> Tuple[bytes, bytes, bytes]:
+        """Run generate() in the render process pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_render_pool(), partial(self.generate, data, **options))
+    
+    async def generate_and_save_async(self, short_code: str, data: str, **options) -> dict:
+        """Async generate_and_save: render in the process pool, write files concurrently"""
+        png_bytes, svg_bytes, pdf_bytes = await self.generate_async(data, **options)
+        return await self.save_files_async(short_code, png_bytes, svg_bytes, pdf_bytes)
 
 
 # Global instance
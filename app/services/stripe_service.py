@@ -1,35 +1,188 @@
 """
 Stripe Payment Service
 """
-import stripe
-from typing import Optional, Dict
-from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import hmac
+import time
+from contextlib import asynccontextmanager
+import httpx
+import orjson
+from typing import Any, Optional, Dict, Union
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from fastapi import Request
 from app.config import settings
+from sqlalchemy import DateTime, Integer, literal, or_, update
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import expression
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.models import User, SubscriptionPlan
 
-# Initialize Stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
+# Webhook signing secret, encoded once
+_WEBHOOK_SECRET = settings.STRIPE_WEBHOOK_SECRET.encode()
+
+# Max age (seconds) of a signed webhook, as in the stripe SDK
+WEBHOOK_TOLERANCE_SECONDS = 300
+
+# Subscription statuses after which the user is back on FREE
+ENDED_SUBSCRIPTION_STATUSES = ("canceled", "unpaid", "incomplete_expired")
+
+def _form_fields(params: Dict[str, Any], prefix: str = "") -> Dict[str, str]:
+    """Flatten nested params into Stripe's form encoding (e.g. metadata[user_id])"""
+    fields = {}
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else key
+        if isinstance(value, dict):
+            fields.update(_form_fields(value, name))
+        elif isinstance(value, list):
+            fields.update(_form_fields({str(i): item for i, item in enumerate(value)}, name))
+        elif isinstance(value, bool):
+            fields[name] = "true" if value else "false"  # Stripe rejects Python's True/False
+        elif value is not None:
+            fields[name] = str(value)
+    return fields
+
+
+class utc_now_plus_days(expression.FunctionElement):
+    """SQL expression for the database's current UTC time plus a number of days"""
+    type = DateTime()
+    inherit_cache = True
+    
+    def __init__(self, days: int):
+        # Bound parameter, so it is part of the statement cache key
+        super().__init__(literal(days, Integer()))
+
+
+@compiles(utc_now_plus_days)
+def _compile_utc_now_plus_days(element, compiler, **kw):
+    return f"(timezone('utc', now()) + make_interval(days => {compiler.process(element.clauses, **kw)}))"
+
+
+@compiles(utc_now_plus_days, "sqlite")
+def _compile_utc_now_plus_days_sqlite(element, compiler, **kw):
+    return f"datetime('now', '+' || {compiler.process(element.clauses, **kw)} || ' days')"
+
+
+class TooManyStripeRequests(Exception):
+    """A user already has the maximum number of Stripe requests in flight"""
+
+
+class StripeAPIError(ValueError):
+    """A Stripe API call failed (error response, unreadable body or transport error)"""
+
+
+def to_cents(amount: Union[Decimal, float]) -> int:
+    """Convert a euro amount to integer cents without float rounding errors (19.99 -> 1999)"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
 
 
 class StripeService:
     """Service for handling Stripe payments and subscriptions"""
     
     def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None  # Opened by startup()
+        # Bound outbound calls per process (below Stripe's 100 req/s) and per user
+        self._semaphore = asyncio.Semaphore(settings.STRIPE_MAX_CONCURRENCY)
+        self._user_in_flight: Dict[int, int] = {}
         self.price_ids = {
             "pro": settings.STRIPE_PRICE_ID_PRO,
             "business": settings.STRIPE_PRICE_ID_BUSINESS,
         }
+        self.plans_by_price = {price_id: plan for plan, price_id in self.price_ids.items() if price_id}
+        # Plan-specific checkout fields, form-encoded once
+        self._checkout_fields = {
+            plan: _form_fields({
+                "payment_method_types": ["card"],
+                "line_items": [{
+                    "price": price_id,
+                    "quantity": 1,
+                }],
+                "mode": "subscription",
+                "metadata": {"plan": plan},
+            })
+            for plan, price_id in self.price_ids.items() if price_id
+        }
+    
+    async def startup(self) -> None:
+        """Open the pooled async Stripe API client (inside the running event loop)"""
+        self.client = httpx.AsyncClient(
+            base_url="https://api.stripe.com",
+            auth=(settings.STRIPE_SECRET_KEY, ""),
+            timeout=30,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+        )
+    
+    async def shutdown(self) -> None:
+        """Close pooled Stripe API connections"""
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+    
+    @asynccontextmanager
+    async def user_slot(self, user_id: int):
+        """Hold one of the user's concurrent Stripe request slots for the block"""
+        in_flight = self._user_in_flight.get(user_id, 0)
+        if in_flight >= settings.STRIPE_MAX_CONCURRENCY_PER_USER:
+            raise TooManyStripeRequests(f"User {user_id} has {in_flight} Stripe requests in flight")
+        
+        self._user_in_flight[user_id] = in_flight + 1
+        try:
+            yield
+        finally:
+            remaining = self._user_in_flight[user_id] - 1
+            if remaining:
+                self._user_in_flight[user_id] = remaining
+            else:
+                del self._user_in_flight[user_id]
+    
+    async def _post(
+        self,
+        path: str,
+        params: Dict[str, Any],
+        idempotency_key: Optional[str] = None,
+        encoded: Optional[Dict[str, str]] = None
+    ) -> Dict:
+        """POST params (plus already form-encoded fields) to the Stripe API and return the JSON object"""
+        headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+        data = {**encoded, **_form_fields(params)} if encoded else _form_fields(params)
+        if self._semaphore.locked():
+            print(f"[STRIPE] {settings.STRIPE_MAX_CONCURRENCY} calls in flight, queueing {path}")
+        async with self._semaphore:
+            try:
+                response = await self.client.post(path, data=data, headers=headers)
+            except httpx.HTTPError as e:
+                raise StripeAPIError(f"Stripe request failed: {e!r}") from e
+        
+        # Proxies and outages can answer with HTML, so only parse JSON bodies
+        body = None
+        if response.headers.get("content-type", "").startswith("application/json"):
+            try:
+                body = response.json()
+            except ValueError:
+                pass
+        if response.is_error:
+            message = body.get("error", {}).get("message") if isinstance(body, dict) else None
+            raise StripeAPIError(f"Stripe error: {message or response.status_code}")
+        if not isinstance(body, dict):
+            raise StripeAPIError(f"Stripe returned an unreadable response ({response.status_code})")
+        return body
     
     async def create_customer(self, user: User) -> str:
         """Create Stripe customer for user"""
-        customer = stripe.Customer.create(
-            email=user.email,
-            name=user.full_name or user.email,
-            metadata={
+        email, name = user.email, user.full_name or user.email
+        # Concurrent checkouts for the same user get the same customer back; the
+        # key covers the parameters, since Stripe rejects a reused key whose
+        # parameters changed (and a reset database can reuse user IDs)
+        params_hash = hashlib.sha256(f"{email}|{name}".encode()).hexdigest()[:16]
+        customer = await self._post("/v1/customers", {
+            "email": email,
+            "name": name,
+            "metadata": {
                 "user_id": user.id,
             }
-        )
-        return customer.id
+        }, idempotency_key=f"customer-user-{user.id}-{params_hash}")
+        return customer["id"]
     
     async def create_checkout_session(
         self,
@@ -40,37 +193,30 @@ class StripeService:
     ) -> Dict:
         """Create Stripe Checkout session for subscription"""
         
-        # Ensure user has Stripe customer ID
-        if not user.stripe_customer_id:
-            customer_id = await self.create_customer(user)
-        else:
-            customer_id = user.stripe_customer_id
-        
-        # Get price ID for plan
-        price_id = self.price_ids.get(plan)
-        if not price_id:
+        # Validate the plan before any Stripe call
+        plan_fields = self._checkout_fields.get(plan)
+        if not plan_fields:
             raise ValueError(f"Invalid plan: {plan}")
         
+        # Ensure user has Stripe customer ID (stored on the user, which the
+        # caller commits, so the customer is only created once)
+        if not user.stripe_customer_id:
+            user.stripe_customer_id = await self.create_customer(user)
+        customer_id = user.stripe_customer_id
+        
         # Create checkout session
-        session = stripe.checkout.Session.create(
-            customer=customer_id,
-            payment_method_types=["card"],
-            line_items=[{
-                "price": price_id,
-                "quantity": 1,
-            }],
-            mode="subscription",
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
+        session = await self._post("/v1/checkout/sessions", {
+            "customer": customer_id,
+            "success_url": success_url,
+            "cancel_url": cancel_url,
+            "metadata": {
                 "user_id": user.id,
-                "plan": plan,
             }
-        )
+        }, encoded=plan_fields)
         
         return {
-            "session_id": session.id,
-            "url": session.url,
+            "session_id": session["id"],
+            "url": session["url"],
         }
     
     async def create_portal_session(self, user: User, return_url: str) -> str:
@@ -78,70 +224,125 @@ class StripeService:
         if not user.stripe_customer_id:
             raise ValueError("User has no Stripe customer ID")
         
-        session = stripe.billing_portal.Session.create(
-            customer=user.stripe_customer_id,
-            return_url=return_url,
-        )
+        session = await self._post("/v1/billing_portal/sessions", {
+            "customer": user.stripe_customer_id,
+            "return_url": return_url,
+        })
         
-        return session.url
+        return session["url"]
     
-    async def handle_checkout_completed(self, session: Dict, user: User) -> None:
-        """Handle successful checkout completion"""
-        subscription_id = session.get("subscription")
-        plan = session.get("metadata", {}).get("plan")
+    async def handle_checkout_completed(self, session: Dict, db: AsyncSession) -> Optional[str]:
+        """Handle successful checkout completion, returning the user's email (None if no user matched)"""
+        user_id = session.get("metadata", {}).get("user_id")
+        if not user_id or not str(user_id).isdigit():
+            return None
         
-        # Update user subscription
+        values = {
+            "stripe_subscription_id": session.get("subscription"),
+            # Set subscription end date (30 days from now, by the database clock)
+            "subscription_ends_at": utc_now_plus_days(30),
+        }
+        
+        plan = session.get("metadata", {}).get("plan")
         if plan == "pro":
-            user.subscription_plan = SubscriptionPlan.PRO
+            values["subscription_plan"] = SubscriptionPlan.PRO
         elif plan == "business":
-            user.subscription_plan = SubscriptionPlan.BUSINESS
-        
-        user.stripe_subscription_id = subscription_id
+            values["subscription_plan"] = SubscriptionPlan.BUSINESS
         
-        # Set subscription end date (30 days from now)
-        user.subscription_ends_at = datetime.utcnow() + timedelta(days=30)
+        # Update user subscription and read back the email in one round trip
+        return await db.scalar(
+            update(User)
+            .where(User.id == int(user_id))
+            .values(**values)
+            .returning(User.email)
+        )
     
-    async def handle_subscription_updated(self, subscription: Dict) -> None:
-        """Handle subscription update webhook"""
-        # This would update user's subscription status in database
-        pass
+    async def handle_subscription_updated(self, subscription: Dict, db: AsyncSession) -> None:
+        """Handle subscription update webhook (plan change, renewal or lapse)"""
+        if subscription.get("status") in ENDED_SUBSCRIPTION_STATUSES:
+            await self.handle_subscription_deleted(subscription, db)
+            return
+        
+        values = {}
+        items = subscription.get("items", {}).get("data", [])
+        plan = self.plans_by_price.get(items[0]["price"]["id"]) if items else None
+        if plan:
+            values["subscription_plan"] = SubscriptionPlan(plan)
+        if subscription.get("current_period_end"):
+            values["subscription_ends_at"] = datetime.utcfromtimestamp(subscription["current_period_end"])
+        
+        # Single UPDATE keyed by subscription ID, no user SELECT first; rows that
+        # already match (Stripe resends unchanged subscriptions) are not rewritten
+        if values:
+            await db.execute(
+                update(User)
+                .where(
+                    User.stripe_subscription_id == subscription["id"],
+                    or_(*(getattr(User, column).is_distinct_from(value) for column, value in values.items()))
+                )
+                .values(**values)
+            )
     
-    async def handle_subscription_deleted(self, subscription: Dict, user: User) -> None:
+    async def handle_subscription_deleted(self, subscription: Dict, db: AsyncSession) -> None:
         """Handle subscription cancellation"""
-        user.subscription_plan = SubscriptionPlan.FREE
-        user.stripe_subscription_id = None
-        user.subscription_ends_at = None
+        await db.execute(
+            update(User)
+            .where(User.stripe_subscription_id == subscription["id"])
+            .values(
+                subscription_plan=SubscriptionPlan.FREE,
+                stripe_subscription_id=None,
+                subscription_ends_at=None
+            )
+        )
     
     async def create_payment_intent(
         self,
-        amount: float,
+        amount: Union[Decimal, float],
         currency: str = "eur",
         metadata: Optional[Dict] = None
     ) -> Dict:
         """Create one-time payment intent (for template purchases)"""
-        intent = stripe.PaymentIntent.create(
-            amount=int(amount * 100),  # Convert to cents
-            currency=currency,
-            metadata=metadata or {},
-        )
+        intent = await self._post("/v1/payment_intents", {
+            "amount": to_cents(amount),
+            "currency": currency,
+            "metadata": metadata or {},
+        })
         
         return {
-            "client_secret": intent.client_secret,
-            "id": intent.id,
+            "client_secret": intent["client_secret"],
+            "id": intent["id"],
         }
     
     def verify_webhook_signature(self, payload: bytes, sig_header: str) -> Dict:
         """Verify Stripe webhook signature"""
+        # Header format: t=<timestamp>,v1=<hex signature>[,v1=...] (several v1
+        # entries while a signing secret is being rolled)
+        timestamp, signatures = None, []
+        for item in (sig_header or "").split(","):
+            key, _, value = item.strip().partition("=")
+            if key == "t":
+                timestamp = value
+            elif key == "v1":
+                signatures.append(value)
+        
+        if not timestamp or not timestamp.isdigit() or not signatures:
+            raise ValueError("Invalid signature")
+        
+        # Reject stale (possibly replayed) deliveries
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            raise ValueError("Invalid signature")
+        
+        expected = hmac.new(_WEBHOOK_SECRET, timestamp.encode() + b"." + payload, hashlib.sha256).hexdigest()
+        if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+            raise ValueError("Invalid signature")
+        
+        # Only parse the body once it is known to come from Stripe
         try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-            )
-            return event
-        except ValueError:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
             raise ValueError("Invalid payload")
-        except stripe.error.SignatureVerificationError:
-            raise ValueError("Invalid signature")
 
 
-# Global instance
-stripe_service = StripeService()
+def get_stripe_service(request: Request) -> StripeService:
+    """Dependency returning the app's StripeService (created in the lifespan)"""
+    return request.app.state.stripe_service
@@ -0,0 +1,58 @@
+"""
+In-process caching utilities
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Small in-memory key/value cache with per-entry expiry"""
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()  # Oldest first, so eviction works from the front
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get cached value, or default if missing or expired"""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store value for ttl seconds (defaults to the cache TTL)"""
+        # Re-insert at the end so entries stay ordered by when they were set
+        if self._data.pop(key, None) is None and len(self._data) >= self.maxsize:
+            self._evict()
+
+        expires_in = self.ttl if ttl is None else ttl
+        self._data[key] = (time.monotonic() + expires_in, value)
+
+    def delete(self, key: Hashable) -> None:
+        """Remove key from cache"""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all entries"""
+        self._data.clear()
+
+    def _evict(self) -> None:
+        """Drop expired entries from the oldest end, then the oldest one if still full"""
+        # Stop at the first live entry rather than scanning the whole cache
+        # (an entry set with a shorter TTL behind it expires on its next get)
+        now = time.monotonic()
+        while self._data:
+            expires_at, _ = next(iter(self._data.values()))
+            if expires_at >= now:
+                break
+            self._data.popitem(last=False)
+
+        if len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
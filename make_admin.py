@@ -2,6 +2,7 @@
 Script to promote a user to admin role
 """
 import sys
+from sqlalchemy import update
 from app.database import SessionLocal
 from app.models.user import User, UserRole
 
@@ -10,16 +11,18 @@ def make_admin(email: str):
     """Promote user to admin by email"""
     db = SessionLocal()
     try:
-        # Find user by email
-        user = db.query(User).filter(User.email == email).first()
+        # Update role to admin in one statement (no SELECT first)
+        user = db.execute(
+            update(User)
+            .where(User.email == email)
+            .values(role=UserRole.ADMIN, is_verified=True)  # Make sure admin is verified
+            .returning(User.id, User.full_name)
+        ).first()
         
         if not user:
             print(f"❌ User with email '{email}' not found")
             return False
         
-        # Update role to admin
-        user.role = UserRole.ADMIN
-        user.is_verified = True  # Make sure admin is verified
         db.commit()
         
         print(f"✅ User '{email}' promoted to ADMIN")
@@ -39,21 +42,33 @@ def list_users():
     """List all users"""
     db = SessionLocal()
     try:
-        users = db.query(User).all()
+        # Only the printed columns, streamed in batches instead of loading every User
+        rows = db.query(
+            User.email,
+            User.full_name,
+            User.role,
+            User.is_verified,
+            User.subscription_plan
+        ).yield_per(1000)
         
-        if not users:
-            print("❌ No users found in database")
-            return
+        separator = "-" * 80
+        found = False
+        for email, full_name, role, is_verified, subscription_plan in rows:
+            if not found:
+                print("\n📋 Users in database:")
+                print(separator)
+                found = True
+            sys.stdout.write(
+                f"Email: {email}\n"
+                f"Name: {full_name}\n"
+                f"Role: {role}\n"
+                f"Verified: {is_verified}\n"
+                f"Subscription: {subscription_plan}\n"
+                f"{separator}\n"
+            )
         
-        print("\n📋 Users in database:")
-        print("-" * 80)
-        for user in users:
-            print(f"Email: {user.email}")
-            print(f"Name: {user.full_name}")
-            print(f"Role: {user.role}")
-            print(f"Verified: {user.is_verified}")
-            print(f"Subscription: {user.subscription_plan}")
-            print("-" * 80)
+        if not found:
+            print("❌ No users found in database")
         
     finally:
         db.close()